@@ -429,56 +429,86 @@ def flatten(xs):
 def flatten_list(x):
     return [i for i in flatten(x)]
 
-def markdownToHTML(text):
-    text_split=text.split("$")
-    math_list=text_split.copy()[1::2]
-    for i in range(len(text_split)):
-        if (i%2==1):
-            text_split[i]="PLACEHOLDERFORSOMEMATHHERE"
-    text="".join(text_split)
-    text_split=text.split(r"![](")
-    for j in range(len(text_split)):
-        if (j>0):
-            k=0
-            while (text_split[j][k]!=")"):
-                k+=1
-            if k<len(text_split[j])-1:
-                if text_split[j][k+1]=="{":
-                    while (text_split[j][k]!="}"):
-                        k+=1
-            text_split[j]=[text_split[j][:k],text_split[j][k+1:]]
-    ts=flatten_list(text_split)
-    image_list=ts.copy()[1::2]
-    for i in range(len(ts)):
-        if (i%2==1):
-            ts[i]="PLACEHOLDERFORSOMEIMAGEHERE"
-    text="".join(ts)
-    #text_split=text.split(r"**")
-    #text=""
-    #for i in range(len(text_split)-1):
-    #   text+=text_split[i]
-    #   if (i%2==0):
-    #       text+=r"<strong>"
-    #   else:
-    #       text+=r"</strong>"
-    #text+=text_split[-1]
-    text=text.replace(r"_",r"UNDERSCORECHAR")
-    text=markdown.markdown(text,extensions=['tables'])
-    text=text.replace(r"UNDERSCORECHAR",r"_")
-    text_split=text.split("PLACEHOLDERFORSOMEMATHHERE")
-    text=""
-    for i in range(len(text_split)-1):
-        text+=text_split[i]+"$"+math_list[i]+"$"
-    text+=text_split[-1]
-    text_split=text.split("PLACEHOLDERFORSOMEIMAGEHERE")
-    text=""
-    for i in range(len(text_split)-1):
-        if "{width=" in image_list[i]:
-            text+=text_split[i]+r"![]("+image_list[i]+r"}"
+math_delimiter_re=re.compile(r"\$+|\\[()]")
+
+def math_tokens(text,moodle=False):
+    """
+    Splits text in one pass into alternating text and math pieces; the pieces
+    at odd positions are math. In Markdown math is enclosed in $ (a literal
+    dollar sign is written DOLLAR_SIGN). In Moodle text math is enclosed in
+    \\( \\) or $$, and a single $ is a literal dollar sign, which is returned
+    as DOLLAR_SIGN.
+    """
+    if not(moodle):
+        return text.split("$")
+    pieces=[]
+    piece=[]
+    pos=0
+    for m in math_delimiter_re.finditer(text):
+        piece.append(text[pos:m.start()])
+        pos=m.end()
+        if m.group()=="$":
+            piece.append("DOLLAR_SIGN")
         else:
-            text+=text_split[i]+r"![]("+image_list[i]+r")"
-    text+=text_split[-1]
-    return text
+            pieces.append("".join(piece))
+            piece=[]
+    piece.append(text[pos:])
+    pieces.append("".join(piece))
+    return pieces
+
+from markdown.extensions import Extension
+from markdown.preprocessors import Preprocessor
+
+image_markdown_re=re.compile(r"!\[\]\([^)]*\)(?:\{[^}]*\})?")
+
+class MoodlePreprocessor(Preprocessor):
+    """
+    Stashes the math and the (possibly sized) images, so they are passed
+    through unchanged by the rest of the render.
+    """
+    def run(self,lines):
+        stash=self.md.htmlStash.store
+        pieces=math_tokens("\n".join(lines))
+        for i,p in enumerate(pieces):
+            if (i%2==1):
+                pieces[i]=stash("$"+p+"$")
+            elif "![](" in p:
+                pieces[i]=image_markdown_re.sub(lambda m: stash(m.group()),p)
+        return "".join(pieces).split("\n")
+
+class MoodleExtension(Extension):
+    """
+    Markdown as used in question texts: math and images are left alone and
+    underscores are never emphasis.
+    """
+    def extendMarkdown(self,md):
+        md.preprocessors.register(MoodlePreprocessor(md),'moodle',25)
+        if 'em_strong2' in md.inlinePatterns:
+            md.inlinePatterns.deregister('em_strong2')
+        else:
+            md.delimiters.remove("_")
+        md.ESCAPED_CHARS=[c for c in md.ESCAPED_CHARS if c!="_"]
+
+import threading
+
+markdown_pool=[]
+markdown_pool_lock=threading.Lock()
+MARKDOWN_POOL_SIZE=8
+
+def markdownToHTML(text):
+    # Markdown instances are reused from a small pool, reset between
+    # documents, instead of loading the extensions again for every question.
+    # A renderer is only used by one thread at a time.
+    with markdown_pool_lock:
+        md=markdown_pool.pop() if markdown_pool else None
+    if md is None:
+        md=markdown.Markdown(extensions=['tables',MoodleExtension()])
+    try:
+        return md.reset().convert(text)
+    finally:
+        with markdown_pool_lock:
+            if len(markdown_pool)<MARKDOWN_POOL_SIZE:
+                markdown_pool.append(md)
 
 
 # # Arguments of functions to XML
@@ -502,30 +532,49 @@ DEFAULT_TOL=0.0125
 
 
 def fix_latex(s):
-    s=s.split("$")
-    i=1
-    t=""
-    for p in s:
-        if (i%2==0):
+    t=[]
+    for i,p in enumerate(math_tokens(s)):
+        if "\n\n" in p:
+            p=p.replace("\n\n","</p><p>")
+        if "DOLLAR_SIGN" in p:
+            p=p.replace(r"DOLLAR_SIGN",r"$")
+        if (i%2==1):
             #p=p.replace("{","{ ")
             p=r"\("+p+r"\)"
-        t+=p
-        i+=1
-    t=t.replace("\n\n","</p><p>")
-    t=t.replace(r"DOLLAR_SIGN",r"$")
-    return t
+        t.append(p)
+    return "".join(t)
 
 
 # In[17]:
 
 
 import base64
+import contextvars
+
+# Per-conversion settings of the in-memory API. They are context variables,
+# so concurrent conversions in different threads do not see each other's.
+image_files=contextvars.ContextVar('image_files',default=None)
+random_state=contextvars.ContextVar('random_state',default=None)
+
+def read_image(filename):
+    files=image_files.get()
+    if files is None:
+        with open(filename, "rb") as imageFile:
+            return imageFile.read()
+    if callable(files):
+        return files(filename)
+    return files[filename]
+
 def import_image(questiontext,filename,serverfilename="",width=550):
     filename=filename.replace("$","SsS").replace(r"?","QqQ")
     if (serverfilename==""):
         serverfilename=filename
-    with open(filename, "rb") as imageFile:
-        encodedString = base64.b64encode(imageFile.read())
+    files=image_files.get()
+    if hasattr(files,'b64'):
+        encodedString = files.b64(filename)
+    else:
+        encodedString = base64.b64encode(read_image(filename))
+    report_progress(image_bytes=len(encodedString))
     f=Sub(questiontext,'file')
     f.set('name',serverfilename)
     f.set('path',r"/")
@@ -627,6 +676,103 @@ def fix_images(t,text):
     return text
 
 
+# # Question model
+
+# In[ ]:
+
+
+import collections
+
+# Answers are tuples, so the create_* functions can index them as before.
+Answer=collections.namedtuple('Answer',['answer','fraction'])
+NumericalAnswer=collections.namedtuple('NumericalAnswer',['answer','fraction','tolerance'])
+CalculatedAnswer=collections.namedtuple('CalculatedAnswer',['answer','fraction','tolerance','length'])
+
+class Variable(object):
+    """
+    A dataset variable of a calculated question, with its values packed in
+    one float array. Fields can also be read and set as v['name'].
+    """
+    __slots__=('name','minmax','decimals','shared','order','expression','sigfigs','values','xml')
+
+    def __init__(self,name,minmax,decimals,shared=True,order=0,expression='',sigfigs=3,values=None):
+        self.name=name
+        self.minmax=minmax
+        self.decimals=decimals
+        self.shared=shared
+        self.order=order
+        self.expression=expression
+        self.sigfigs=sigfigs
+        self.values=None if values is None else np.asarray(values,dtype=float)
+        self.xml={}
+
+    def __getitem__(self,key):
+        try:
+            return getattr(self,key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self,key,value):
+        if key=='values':
+            value=np.asarray(value,dtype=float)
+        setattr(self,key,value)
+        self.xml={} # the dataset definition has to be rebuilt
+
+def as_variable(v):
+    """
+    Returns v as a Variable; v may also be a dict as made by earlier versions
+    of sample_var ("name" and "values", optionally "minmax", "decimals",
+    "shared", "order", "expression" and "sigfigs").
+    """
+    if isinstance(v,Variable):
+        return v
+    values=np.asarray(v['values'],dtype=float)
+    minmax=v.get('minmax')
+    if minmax is None:
+        minmax=[values.min(),values.max()] if len(values) else [0,0]
+    return Variable(v['name'],minmax,v.get('decimals',0),shared=v.get('shared',True),order=v.get('order',0),
+                    expression=v.get('expression',''),sigfigs=v.get('sigfigs',3),values=values)
+
+class Question(object):
+    """
+    A question as read from either format: category, description, essay and
+    cloze questions only have a type, a name and a text; the subclasses add
+    the fields of the other types.
+    """
+    __slots__=('type','name','text')
+
+    def __init__(self,type,name,text,**fields):
+        self.type=type
+        self.name=name
+        self.text=text
+        for k,v in fields.items():
+            setattr(self,k,v)
+
+class DragDropQuestion(Question):
+    __slots__=('drag_drop','shuffle','showmisplaced')
+
+class RandomMatchQuestion(Question):
+    __slots__=('choose','subcats')
+
+class ShortAnswerQuestion(Question):
+    __slots__=('case','answers')
+
+class CalculatedQuestion(Question):
+    __slots__=('var','answers')
+
+class MatchingQuestion(Question):
+    __slots__=('QA','shuffle')
+
+class MultichoiceQuestion(Question):
+    __slots__=('answers','single_answer','shuffle')
+
+class GapselectQuestion(Question):
+    __slots__=('wrong_answers','shuffle')
+
+class NumericalQuestion(Question):
+    __slots__=('answers',)
+
+
 # In[20]:
 
 
@@ -667,17 +813,13 @@ def ceil_to_sigfigs(num,sigfigs=3):
 
 
 def sample_var(name,minmax=[1,10],count=50,shared=True,decimals=-1e6,sigfigs=3):
-    vals=np.random.uniform(minmax[0],minmax[1],size=count)
+    vals=(random_state.get() or np.random).uniform(minmax[0],minmax[1],size=count)
     if (decimals==-1e6):
         decimals=-(1+np.floor(np.log10(max(np.abs(minmax[0]),np.abs(minmax[1]))))-sigfigs)
     vals=round_to_sigfigs(vals,sigfigs)
     if (decimals<=-0):
         decimals=0
-    return {"name":name,
-            "minmax":minmax,
-            "decimals":round(decimals),
-            "values":vals,
-            "shared":shared,'order':0}
+    return Variable(name,minmax,round(decimals),shared=shared,values=vals)
 
 def create_var_from_array(name,arr,shared=True,sigfigs=3,extrema_sigfigs=1,order=0,expression=''):
     arr=round_to_sigfigs(arr,sigfigs)
@@ -689,14 +831,7 @@ def create_var_from_array(name,arr,shared=True,sigfigs=3,extrema_sigfigs=1,order
     decimals=-(1+np.floor(np.log10(max(np.abs(minmax[0]),np.abs(minmax[1]))))-sigfigs)
     if (decimals<=-0):
         decimals=0
-    return {"name":name,
-            "minmax":minmax,
-            "decimals":round(decimals),
-            "values":arr,
-            "shared":shared,
-            'order':order,
-            'expression':expression
-           }
+    return Variable(name,minmax,round(decimals),shared=shared,order=order,expression=expression,values=arr)
 
 
 # In[21]:
@@ -935,6 +1070,64 @@ def create_matching(quiz,name,text,QA,shuffle=True):
 # In[ ]:
 
 
+def add_calculated_answers(q,answers,tolerance=DEFAULT_TOL,tolerancetype="1",correctanswerformat="2",correctanswerlength=3):
+    if type(answers)==str:
+        answers=[[answers,100]]
+    for ans in answers:
+        a=Sub(q,'answer')
+        a.set('fraction',str(ans[1]))
+        Sub(a,'text').text=ans[0]
+        if len(ans)==3:
+            tolerance=abs(ans[2])
+        if len(ans)==4:
+            correctanswerlength=ans[3]
+        Sub(a,'tolerance').text=str(tolerance)
+        Sub(a,'tolerancetype').text=tolerancetype  #1=relative (set default) 2=nominal
+        Sub(a,'correctanswerformat').text=correctanswerformat # 2=sigfigs (set default) 1=decimals
+        Sub(a,'correctanswerlength').text=str(correctanswerlength)
+
+def dataset_definition_xml(v,q_type='calculated'):
+    """
+    Returns the <dataset_definition> element of variable v. It is cached on
+    v and appended to every question using v, so a shared variable is built
+    once per category however many questions use it.
+    """
+    cache=v.xml
+    if q_type in cache:
+        return cache[q_type]
+    data1=Ele("dataset_definition")
+    if len(v.expression)>0:
+        Sub(Sub(data1,'expression'),"text").text=r"<![CDATA["+v.expression+"]]>"
+        Sub(data1,'order').text=str(v.order)
+    if (v.shared==True) and (q_type!='calculatedsimple'):
+        Sub(Sub(data1,"status"),"text").text="shared"
+    else:
+        Sub(Sub(data1,"status"),"text").text="private"
+    Sub(Sub(data1,"name"),"text").text=v.name
+    Sub(data1,"type").text=q_type
+    Sub(Sub(data1,"distribution"),"text").text="uniform"
+    Sub(Sub(data1,"minimum"),"text").text=str(v.minmax[0])
+    Sub(Sub(data1,"maximum"),"text").text=str(v.minmax[1])
+    Sub(Sub(data1,"decimals"),"text").text=str(v.decimals)
+    Sub(data1,"itemcount").text=str(len(v.values))
+    Sub(data1,"number_of_items").text=str(len(v.values))
+    items=Sub(data1,'dataset_items')
+    i=1
+    for val in v.values:
+        item=Sub(items,'dataset_item')
+        Sub(item,'number').text=str(i)
+        Sub(item,'value').text=str(val)
+        i+=1
+    cache[q_type]=data1
+    return data1
+
+def add_dataset_definitions(q,var,q_type='calculated'):
+    Sub(q,"dataset_definitions").extend([dataset_definition_xml(as_variable(v),q_type) for v in var])
+
+
+# In[ ]:
+
+
 def create_calculatedmulti(quiz,name,text,answers,var,tolerance=DEFAULT_TOL,tolerancetype="1",correctanswerformat="2",correctanswerlength=3,single_answer=True):
     q=Sub(quiz,'question')
     q.set('type','calculatedmulti')
@@ -976,50 +1169,8 @@ def create_calculatedmulti(quiz,name,text,answers,var,tolerance=DEFAULT_TOL,tole
     Sub(q,'showunits').text="3"
     Sub(q,'unitsleft').text="0"
     ####
-    if type(answers)==str:
-        answers=[[answers,100]]
-    for ans in answers:
-        a=Sub(q,'answer')
-        a.set('fraction',str(ans[1]))
-        Sub(a,'text').text=ans[0]
-        if len(ans)==3:
-            tolerance=abs(ans[2])
-        if len(ans)==4:
-            correctanswerlength=ans[3]
-        Sub(a,'tolerance').text=str(tolerance)
-        Sub(a,'tolerancetype').text=tolerancetype  #1=relative (set default) 2=nominal
-        Sub(a,'correctanswerformat').text=correctanswerformat # 2=sigfigs (set default) 1=decimals
-        Sub(a,'correctanswerlength').text=str(correctanswerlength)
-    ####
-    data=Sub(q,"dataset_definitions")
-    for v in var:
-        data1=Sub(data,"dataset_definition")
-        try:
-            if len(v['expression'])>0:
-                Sub(Sub(data1,'expression'),"text").text=r"<![CDATA["+v['expression']+"]]>"
-                Sub(data1,'order').text=str(v['order'])
-        except:
-            None
-        #print(v['name']+"   "+str(v["shared"]))
-        if v["shared"]==True:
-            Sub(Sub(data1,"status"),"text").text="shared"
-        else:
-            Sub(Sub(data1,"status"),"text").text="private"
-        Sub(Sub(data1,"name"),"text").text=v['name']
-        Sub(data1,"type").text='calculated'
-        Sub(Sub(data1,"distribution"),"text").text="uniform"
-        Sub(Sub(data1,"minimum"),"text").text=str(v["minmax"][0])
-        Sub(Sub(data1,"maximum"),"text").text=str(v["minmax"][1])
-        Sub(Sub(data1,"decimals"),"text").text=str(v["decimals"])
-        Sub(data1,"itemcount").text=str(len(v["values"]))
-        Sub(data1,"number_of_items").text=str(len(v["values"]))
-        items=Sub(data1,'dataset_items')
-        i=1
-        for val in v["values"]:
-            item=Sub(items,'dataset_item')
-            Sub(item,'number').text=str(i)
-            Sub(item,'value').text=str(val)
-            i+=1
+    add_calculated_answers(q,answers,tolerance,tolerancetype,correctanswerformat,correctanswerlength)
+    add_dataset_definitions(q,var,q_type="calculated")
 
 
 # In[27]:
@@ -1048,50 +1199,8 @@ def create_calculated(quiz,name,text,answers,var,tolerance=DEFAULT_TOL,tolerance
     Sub(q,'showunits').text="3"
     Sub(q,'unitsleft').text="0"
     ####
-    if type(answers)==str:
-        answers=[[answers,100]]
-    for ans in answers:
-        a=Sub(q,'answer')
-        a.set('fraction',str(ans[1]))
-        Sub(a,'text').text=ans[0]
-        if len(ans)==3:
-            tolerance=abs(ans[2])
-        if len(ans)==4:
-            correctanswerlength=ans[3]
-        Sub(a,'tolerance').text=str(tolerance)
-        Sub(a,'tolerancetype').text=tolerancetype  #1=relative (set default) 2=nominal
-        Sub(a,'correctanswerformat').text=correctanswerformat # 2=sigfigs (set default) 1=decimals
-        Sub(a,'correctanswerlength').text=str(correctanswerlength)
-    ####
-    data=Sub(q,"dataset_definitions")
-    for v in var:
-        data1=Sub(data,"dataset_definition")
-        try:
-            if len(v['expression'])>0:
-                Sub(Sub(data1,'expression'),"text").text=r"<![CDATA["+v['expression']+"]]>"
-                Sub(data1,'order').text=str(v['order'])
-        except:
-            None
-        #print(v['name']+"   "+str(v["shared"]))
-        if v["shared"]==True:
-            Sub(Sub(data1,"status"),"text").text="shared"
-        else:
-            Sub(Sub(data1,"status"),"text").text="private"
-        Sub(Sub(data1,"name"),"text").text=v['name']
-        Sub(data1,"type").text='calculated'
-        Sub(Sub(data1,"distribution"),"text").text="uniform"
-        Sub(Sub(data1,"minimum"),"text").text=str(v["minmax"][0])
-        Sub(Sub(data1,"maximum"),"text").text=str(v["minmax"][1])
-        Sub(Sub(data1,"decimals"),"text").text=str(v["decimals"])
-        Sub(data1,"itemcount").text=str(len(v["values"]))
-        Sub(data1,"number_of_items").text=str(len(v["values"]))
-        items=Sub(data1,'dataset_items')
-        i=1
-        for val in v["values"]:
-            item=Sub(items,'dataset_item')
-            Sub(item,'number').text=str(i)
-            Sub(item,'value').text=str(val)
-            i+=1
+    add_calculated_answers(q,answers,tolerance,tolerancetype,correctanswerformat,correctanswerlength)
+    add_dataset_definitions(q,var,q_type="calculated")
 
 
 # In[28]:
@@ -1120,46 +1229,8 @@ def create_calculated_simple(quiz,name,text,answers,var,tolerance=DEFAULT_TOL,to
     Sub(q,'showunits').text="3"
     Sub(q,'unitsleft').text="0"
     ####
-    if type(answers)==str:
-        answers=[[answers,100]]
-    for ans in answers:
-        a=Sub(q,'answer')
-        a.set('fraction',str(ans[1]))
-        Sub(a,'text').text=ans[0]
-        if len(ans)==3:
-            tolerance=abs(ans[2])
-        if len(ans)==4:
-            correctanswerlength=ans[3]
-        Sub(a,'tolerance').text=str(tolerance)
-        Sub(a,'tolerancetype').text=tolerancetype  #1=relative (set default) 2=nominal
-        Sub(a,'correctanswerformat').text=correctanswerformat # 2=sigfigs (set default) 1=decimals
-        Sub(a,'correctanswerlength').text=str(correctanswerlength)
-    ####
-    data=Sub(q,"dataset_definitions")
-    for v in var:
-        data1=Sub(data,"dataset_definition")
-        try:
-            if len(v['expression'])>0:
-                Sub(Sub(data1,'expression'),"text").text=r"<![CDATA["+v['expression']+"]]>"
-                Sub(data1,'order').text=str(v['order'])
-        except:
-            None
-        Sub(Sub(data1,"status"),"text").text="private"
-        Sub(Sub(data1,"name"),"text").text=v['name']
-        Sub(data1,"type").text='calculatedsimple'
-        Sub(Sub(data1,"distribution"),"text").text="uniform"
-        Sub(Sub(data1,"minimum"),"text").text=str(v["minmax"][0])
-        Sub(Sub(data1,"maximum"),"text").text=str(v["minmax"][1])
-        Sub(Sub(data1,"decimals"),"text").text=str(v["decimals"])
-        Sub(data1,"itemcount").text=str(len(v["values"]))
-        Sub(data1,"number_of_items").text=str(len(v["values"]))
-        items=Sub(data1,'dataset_items')
-        i=1
-        for val in v["values"]:
-            item=Sub(items,'dataset_item')
-            Sub(item,'number').text=str(i)
-            Sub(item,'value').text=str(val)
-            i+=1
+    add_calculated_answers(q,answers,tolerance,tolerancetype,correctanswerformat,correctanswerlength)
+    add_dataset_definitions(q,var,q_type="calculatedsimple")
 
 
 # In[29]:
@@ -1417,14 +1488,295 @@ def create_missing_words(quiz,name,text,wrong_answers=[],shuffle=True,q_type='ga
 # In[26]:
 
 
-def write_quiz_to_file(quiz,filename):
-    xml=ET.tostring(quiz).decode("ASCII")
+def element_to_xml(el):
+    xml=ET.tostring(el).decode("ASCII")
     xml=xml.replace("&lt;","<")
     xml=xml.replace("&gt;",">")
+    return xml
+
+def write_quiz_to_file(quiz,filename):
+    xml=element_to_xml(quiz)
     with open(filename, "w") as f:
         f.write(xml)
 
 
+# In[ ]:
+
+
+def shard_filename(filename,n):
+    base,ext=os.path.splitext(filename)
+    return base+"_"+str(n).zfill(3)+ext
+
+class ShardedQuizWriter(object):
+    """
+    Streams questions into a series of XML files filename_001.xml, ...
+    A new file is started at every category (split_categories) and/or when
+    the current file would grow beyond max_bytes. Every file begins with the
+    category element of its questions, so that imports land in the right
+    category.
+    """
+    def __init__(self,filename,max_bytes=None,split_categories=False):
+        self.filename=filename
+        self.max_bytes=max_bytes
+        self.split_categories=split_categories
+        self.filenames=[]
+        self.f=None
+        self.category=None
+        self.category_written=True
+
+    def _next_file(self):
+        self._close_file()
+        self.filenames.append(shard_filename(self.filename,len(self.filenames)+1))
+        self.f=open(self.filenames[-1],"w")
+        self.f.write("<quiz>")
+        self.size=len("<quiz></quiz>")
+        self.questions=0
+        self.category_written=False
+
+    def _close_file(self):
+        if self.f is not None:
+            self.f.write("</quiz>")
+            self.f.close()
+            self.f=None
+
+    def _write(self,xml):
+        self.f.write(xml)
+        self.size+=len(xml)
+
+    def _category_pending(self):
+        return (self.category is not None) and not(self.category_written)
+
+    def add(self,xml,is_category=False):
+        if self.f is None:
+            self._next_file()
+        if (is_category):
+            if self._category_pending():
+                self._write(self.category) # keep empty categories
+            if (self.split_categories) and (self.questions>0):
+                self._next_file()
+            self.category=xml
+            self.category_written=False
+            return
+        need=len(xml)
+        if self._category_pending():
+            need+=len(self.category)
+        if (self.max_bytes) and (self.questions>0) and (self.size+need>self.max_bytes):
+            self._next_file()
+        if self._category_pending():
+            self._write(self.category)
+        self.category_written=True
+        self._write(xml)
+        self.questions+=1
+        if (self.max_bytes) and (self.size>self.max_bytes):
+            print("##################################### WARNING: A question alone exceeds the maximum file size: "+self.filenames[-1])
+
+    def close(self):
+        if self.f is None:
+            self._next_file()
+        if self._category_pending():
+            self._write(self.category)
+            self.category_written=True
+        self._close_file()
+        return self.filenames
+
+class PieceCollector(object):
+    """
+    Writer for text_to_xml that keeps the serialized questions and
+    categories as a list of (xml,is_category) pieces.
+    """
+    def __init__(self):
+        self.pieces=[]
+
+    def add(self,xml,is_category=False):
+        self.pieces.append((xml,is_category))
+
+    def close(self):
+        return self.pieces
+
+def serialize_elements(elements,includes=None,state=None):
+    """
+    Yields (xml,is_category) for the question elements, replacing every
+    include marker by the pieces includes returns for its file. The current
+    category (kept in state) is repeated after an included file, so that the
+    questions following it do not land in its categories.
+    """
+    if state is None:
+        state={}
+    for el in elements:
+        if el.tag=='include':
+            if includes is None:
+                raise Exception("INCLUDE: "+el.get('file')+" can only be used when converting a file")
+            for piece in includes(el.get('file')):
+                yield piece
+            if state.get('category') is not None:
+                yield state['category'],True
+        else:
+            xml=element_to_xml(el)
+            if el.get('type')=='category':
+                state['category']=xml
+                yield xml,True
+            else:
+                yield xml,False
+
+def parse_size(size):
+    size=str(size).strip().upper().rstrip("B")
+    units={'K':1024,'M':1024**2,'G':1024**3}
+    if size[-1:] in units:
+        return int(float(size[:-1])*units[size[-1]])
+    return int(size)
+
+
+# # Memory profiling
+
+# In[ ]:
+
+
+import contextlib
+import time
+import tracemalloc
+
+memory_profile=contextvars.ContextVar('memory_profile',default=None)
+
+class MemoryProfile(object):
+    """
+    Records, with tracemalloc, the peak and retained memory of every stage of
+    a conversion and the allocation sites that grew the most in it. Stages
+    can be nested; the peak of a stage includes those of its sub-stages.
+    """
+    def __init__(self,top=10):
+        self.top=top
+        self.stages=[]
+        self.stack=[]
+
+    def start(self):
+        self.was_tracing=tracemalloc.is_tracing()
+        if not(self.was_tracing):
+            tracemalloc.start()
+        self.token=memory_profile.set(self)
+
+    def stop(self):
+        memory_profile.reset(self.token)
+        self.peak=max([s['peak'] for s in self.stages]+[tracemalloc.get_traced_memory()[1]])
+        if not(self.was_tracing):
+            tracemalloc.stop()
+
+    def snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False,tracemalloc.__file__)])
+
+    def enter(self,name):
+        current,peak=tracemalloc.get_traced_memory()
+        if self.stack:
+            self.stack[-1][0]['peak']=max(self.stack[-1][0]['peak'],peak)
+        s={'stage':name,'depth':len(self.stack),'start':current,'peak':current}
+        self.stages.append(s)
+        self.stack.append((s,time.time(),self.snapshot()))
+        tracemalloc.reset_peak()
+
+    def exit(self):
+        current,peak=tracemalloc.get_traced_memory()
+        s,t,snapshot=self.stack.pop()
+        s['peak']=max(s['peak'],peak)
+        if self.stack:
+            self.stack[-1][0]['peak']=max(self.stack[-1][0]['peak'],s['peak'])
+        stats=self.snapshot().compare_to(snapshot,'lineno')
+        s['seconds']=time.time()-t
+        s['retained']=current-s['start']
+        s['top']=[{'site':str(st.traceback),'size_diff':st.size_diff,'count_diff':st.count_diff} for st in stats[:self.top]]
+
+    def report(self):
+        return {'peak':self.peak,'stages':self.stages}
+
+    def write(self,filename):
+        with open(filename,"w") as f:
+            json.dump(self.report(),f,indent=1)
+
+@contextlib.contextmanager
+def profile_stage(name):
+    """
+    Marks a stage of the running MemoryProfile, if any.
+    """
+    prof=memory_profile.get()
+    if prof is None:
+        yield
+        return
+    prof.enter(name)
+    try:
+        yield
+    finally:
+        prof.exit()
+
+
+# # Progress reporting
+
+# In[ ]:
+
+
+import sys
+
+progress_reporter=contextvars.ContextVar('progress_reporter',default=None)
+
+class Progress(object):
+    """
+    Reports the questions converted, their rate, the bytes of images encoded
+    or extracted and the ETA of a conversion, as a progress bar (mode 'bar')
+    or as JSON lines (mode 'json') every interval seconds. Mode 'auto' picks
+    the bar if stream is a terminal.
+    """
+    def __init__(self,mode='auto',stream=None,interval=None):
+        self.stream=stream or sys.stderr
+        if mode=='auto':
+            mode='bar' if self.stream.isatty() else 'json'
+        self.mode=mode
+        self.interval=interval if interval is not None else (0.2 if mode=='bar' else 5.0)
+        self.total=None
+        self.done=0
+        self.image_bytes=0
+
+    def start(self):
+        self.t0=time.time()
+        self.last=self.t0
+        self.token=progress_reporter.set(self)
+
+    def stop(self):
+        progress_reporter.reset(self.token)
+        self.emit(final=True)
+
+    def update(self,questions=0,image_bytes=0,total=None):
+        if total is not None:
+            self.total=total
+        self.done+=questions
+        self.image_bytes+=image_bytes
+        now=time.time()
+        if now-self.last>=self.interval:
+            self.last=now
+            self.emit()
+
+    def emit(self,final=False):
+        elapsed=time.time()-self.t0
+        rate=self.done/elapsed if elapsed>0 else 0.0
+        eta=None
+        if (self.total) and (rate>0):
+            eta=max(0.0,(self.total-self.done)/rate)
+        if self.mode=='json':
+            self.stream.write(json.dumps({'done':self.done,'total':self.total,'elapsed':round(elapsed,3),'rate':round(rate,3),
+                                          'image_bytes':self.image_bytes,'eta':None if eta is None else round(eta,3),'final':final})+"\n")
+        else:
+            line=str(self.done)+(("/"+str(self.total)) if self.total else "")+" questions, "+("%.1f" % rate)+"/s, "
+            line+=("%.1f" % (self.image_bytes/1024**2))+" MB images"
+            if self.total:
+                filled=int(30*min(1.0,self.done/self.total))
+                line="["+"#"*filled+"-"*(30-filled)+"] "+line
+            if (eta is not None) and not(final):
+                line+=", ETA "+time.strftime("%H:%M:%S",time.gmtime(eta))
+            self.stream.write("\r"+line+" "*5+("\n" if final else ""))
+        self.stream.flush()
+
+def report_progress(questions=0,image_bytes=0,total=None):
+    prog=progress_reporter.get()
+    if prog is not None:
+        prog.update(questions,image_bytes,total)
+
+
 # # Text to XML
 
 # In[27]:
@@ -1442,11 +1794,117 @@ def extract_line(text,key):
 
 
 #text="""(MULTICHOICE("kW",["J","s","m/s","(star)"]), MULTICHOICE("kW","["))"""
-def evaluate_cloze_function(text,f):
-    args=extract_arg_of_function(text,f)
-    for arg in args:
-        text=text.replace(f+"("+arg+")",eval(f+"("+arg+")"))
-    return text
+import ast
+import operator
+
+CLOZE_FUNCTIONS={'MULTICHOICE':MULTICHOICE,'NUMERICAL':NUMERICAL,'SHORTANSWER':SHORTANSWER}
+CLOZE_OPERATORS={ast.Add:operator.add,ast.Sub:operator.sub,ast.Mult:operator.mul,ast.Div:operator.truediv,
+                 ast.Mod:operator.mod,ast.Pow:operator.pow}
+cloze_call_re=re.compile(r"\b(MULTICHOICE|NUMERICAL|SHORTANSWER)\(")
+CLOZE_MAX_BITS=4096 # bound on the integers of cloze arithmetic
+
+def cloze_calls(text):
+    """
+    Yields (start,end,name,args) for every cloze function call in text, with
+    args the source between its parentheses. Parentheses inside quoted
+    strings do not count.
+    """
+    pos=0
+    while True:
+        m=cloze_call_re.search(text,pos)
+        if m is None:
+            return
+        depth=1
+        quote=None
+        i=m.end()
+        while (i<len(text)) and (depth>0):
+            c=text[i]
+            if quote is not None:
+                if c=="\\":
+                    i+=1
+                elif c==quote:
+                    quote=None
+            elif c in "\"'":
+                quote=c
+            elif c=="(":
+                depth+=1
+            elif c==")":
+                depth-=1
+            i+=1
+        if depth>0:
+            raise Exception('Unbalanced parentheses in '+m.group(1)+'(...)')
+        yield m.start(),i,m.group(1),text[m.end():i-1]
+        pos=i
+
+def cloze_number(v,node):
+    if isinstance(v,bool) or not(isinstance(v,(int,float))):
+        raise ValueError('Arithmetic on a non-number: '+ast.unparse(node))
+    return v
+
+def cloze_arithmetic(op,left,right,node):
+    if (op is ast.Add) and isinstance(left,str) and isinstance(right,str):
+        return left+right
+    left,right=cloze_number(left,node),cloze_number(right,node)
+    if (op is ast.Pow) and isinstance(left,int) and isinstance(right,int) and (abs(left)>1) and (right>0):
+        if left.bit_length()*right>CLOZE_MAX_BITS:
+            left=float(left) # overflows instead of building a huge integer
+    res=CLOZE_OPERATORS[op](left,right)
+    if isinstance(res,complex):
+        raise ValueError('Complex result: '+ast.unparse(node))
+    if isinstance(res,int) and (res.bit_length()>CLOZE_MAX_BITS):
+        raise ValueError('Number too large: '+ast.unparse(node))
+    return res
+
+def cloze_literal(node):
+    """
+    Value of a literal argument of a cloze function: numbers, strings, lists
+    and tuples of them, arithmetic on numbers and concatenation of strings.
+    Anything else is refused, as are integers beyond CLOZE_MAX_BITS.
+    """
+    if isinstance(node,ast.Constant):
+        return node.value
+    if isinstance(node,ast.List):
+        return [cloze_literal(e) for e in node.elts]
+    if isinstance(node,ast.Tuple):
+        return tuple([cloze_literal(e) for e in node.elts])
+    if isinstance(node,ast.UnaryOp) and isinstance(node.op,(ast.USub,ast.UAdd)):
+        v=cloze_number(cloze_literal(node.operand),node)
+        return -v if isinstance(node.op,ast.USub) else +v
+    if isinstance(node,ast.BinOp) and (type(node.op) in CLOZE_OPERATORS):
+        return cloze_arithmetic(type(node.op),cloze_literal(node.left),cloze_literal(node.right),node)
+    raise ValueError('Not a literal: '+ast.unparse(node))
+
+def parse_cloze_call(name,args):
+    """
+    Parses the arguments of a cloze function call into (args,kwargs).
+    """
+    call=ast.parse(name+"("+args+")",mode='eval').body
+    for a in call.args:
+        if isinstance(a,ast.Starred):
+            raise ValueError('Not a literal: '+ast.unparse(a))
+    for k in call.keywords:
+        if k.arg is None:
+            raise ValueError('Not a literal: **'+ast.unparse(k.value))
+    return [cloze_literal(a) for a in call.args],dict((k.arg,cloze_literal(k.value)) for k in call.keywords)
+
+def compile_cloze(text):
+    """
+    Replaces every MULTICHOICE(...), NUMERICAL(...) and SHORTANSWER(...) call
+    in text by the cloze code it generates, in one pass.
+    """
+    pieces=[]
+    pos=0
+    for start,end,name,args in cloze_calls(text):
+        try:
+            a,kw=parse_cloze_call(name,args)
+            code=CLOZE_FUNCTIONS[name](*a,**kw)
+        except (SyntaxError,ValueError,TypeError,ArithmeticError) as e:
+            raise Exception('Cannot parse '+name+'('+args+'): '+str(e))
+        pieces.append(text[pos:start])
+        pieces.append(code)
+        pos=end
+    pieces.append(text[pos:])
+    return "".join(pieces)
 
 
 # In[29]:
@@ -1492,7 +1950,7 @@ def extract_vars(text,N,shared=True):
             else:
                 dicd=dic[d]
                 for d1 in list(dic.keys())[:i]:
-                    dic[d]=re.sub(r'\b'+d1+r'\b', "dic[\'"+d1+"\']['values']", dic[d])
+                    dic[d]=re.sub(r'\b'+d1+r'\b', "dic[\'"+d1+"\'].values", dic[d])
                 dic[d]="create_var_from_array('"+d+"',"+dic[d]+",expression=\"\"\""+dicd+"\"\"\",shared="+str(shared)+",sigfigs="+str(sig)+",order="+str(i)+")"
             #print(d+"   "+dic[d])
             dic[d]=eval(dic[d])
@@ -1518,8 +1976,142 @@ def find_used_vars(string):
 
 
 def strip_latex(text):
-    a=text.split("$")
-    return "".join(a[0::2])
+    return "".join(math_tokens(text)[0::2])
+
+
+# In[ ]:
+
+
+import functools
+
+def php_round(x,precision=0):
+    p=10.0**precision
+    return np.sign(x)*np.floor(np.abs(x)*p+0.5)/p
+
+def php_log(x,base=None):
+    if base is None:
+        return np.log(x)
+    return np.log(x)/np.log(base)
+
+FORMULA_FUNCTIONS={'abs':np.abs,'acos':np.arccos,'acosh':np.arccosh,'asin':np.arcsin,'asinh':np.arcsinh,
+                   'atan':np.arctan,'atan2':np.arctan2,'atanh':np.arctanh,'ceil':np.ceil,'cos':np.cos,
+                   'cosh':np.cosh,'deg2rad':np.deg2rad,'exp':np.exp,'expm1':np.expm1,'floor':np.floor,
+                   'fmod':np.fmod,'is_finite':np.isfinite,'is_infinite':np.isinf,'is_nan':np.isnan,
+                   'log':php_log,'log10':np.log10,'log1p':np.log1p,'max':np.maximum,'min':np.minimum,
+                   'pi':lambda: np.pi,'pow':lambda a,b: np.power(np.asarray(a,dtype=float),b),
+                   'rad2deg':np.rad2deg,'round':php_round,'sin':np.sin,'sinh':np.sinh,'sqrt':np.sqrt,
+                   'tan':np.tan,'tanh':np.tanh}
+formula_token_re=re.compile(r"\s*(?:\{([A-Za-z_]\w*)\}|([A-Za-z_]\w*)|((?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)|(\S))")
+MAX_MAGNITUDE=1e15
+MIN_MAGNITUDE=1e-15
+
+@functools.lru_cache(maxsize=None)
+def compile_formula(formula):
+    """
+    Translates a Moodle formula such as pow({a},1.5)/pi() into a NumPy
+    expression over the dict _v of dataset values and compiles it.
+    """
+    out=[]
+    for var,name,number,op in formula_token_re.findall(formula):
+        if var:
+            out.append("_v['"+var+"']")
+        elif name:
+            if not(name in FORMULA_FUNCTIONS):
+                raise Exception('Unknown function in formula: '+name)
+            out.append(name)
+        elif number:
+            out.append(number)
+        elif op in "+-*/(),%":
+            out.append(op)
+        else:
+            raise Exception('Unexpected character in formula: '+op)
+    expr=" ".join(out)
+    if ("* *" in expr) or ("/ /" in expr):
+        raise Exception('Unexpected operator in formula: '+formula)
+    return compile(expr,"<formula>","eval")
+
+def evaluate_formula(formula,values):
+    """
+    Evaluates formula for all dataset items at once; values maps variable
+    names to arrays of samples. Returns a float array.
+    """
+    n=max([len(v) for v in values.values()]+[1])
+    with np.errstate(all='ignore'):
+        res=eval(compile_formula(formula),{'__builtins__':{},'_v':values},FORMULA_FUNCTIONS)
+    return np.broadcast_to(np.asarray(res,dtype=float),(n,))
+
+def split_embedded_formulas(text):
+    """
+    Splits a calculatedmulti answer into its literal text and its {=...}
+    formulas (which may contain {var} braces).
+    """
+    parts=[]
+    formulas=[]
+    last=0
+    i=text.find("{=")
+    while i>=0:
+        depth=0
+        for j in range(i,len(text)):
+            if text[j]=="{":
+                depth+=1
+            elif text[j]=="}":
+                depth-=1
+                if depth==0:
+                    break
+        else:
+            raise Exception('Unbalanced braces in answer: '+text)
+        parts.append(text[last:i])
+        formulas.append(text[i+2:j])
+        last=j+1
+        i=text.find("{=",last)
+    parts.append(text[last:])
+    return tuple(parts),formulas
+
+def check_calculated_answers(answers,var,q_type='calculated',tolerance=DEFAULT_TOL):
+    """
+    Evaluates every answer of a calculated question over all dataset items
+    and returns a list of warnings: formulas giving NaN/inf or extreme
+    magnitudes, and answers of different weights that can not be told apart
+    (same text, values within tolerance) for some of the items.
+    """
+    if type(answers)==str:
+        answers=[[answers,100.0]]
+    var=[as_variable(v) for v in var]
+    values=dict((v.name,v.values) for v in var)
+    warnings=[]
+    evaluated=[]
+    for ans in answers:
+        text,weight=ans[0],ans[1]
+        try:
+            if q_type=='calculatedmulti':
+                parts,formulas=split_embedded_formulas(text)
+            else:
+                parts,formulas=(),[text]
+            res=np.array([evaluate_formula(f,values) for f in formulas])
+        except Exception as e:
+            warnings.append("Cannot evaluate answer "+text+": "+str(e))
+            continue
+        n=res.shape[-1] if res.size else 0
+        bad=~np.isfinite(res)
+        if bad.any():
+            warnings.append("Answer "+text+" is NaN or infinite for "+str(bad.any(axis=0).sum())+" of "+str(n)+" dataset items")
+        a=np.abs(res[~bad])
+        if (a>MAX_MAGNITUDE).any() or ((a>0)&(a<MIN_MAGNITUDE)).any():
+            warnings.append("Answer "+text+" reaches extreme values between "+str(a.min())+" and "+str(a.max()))
+        evaluated.append((text,float(weight),parts,res))
+    for i in range(len(evaluated)):
+        for j in range(i+1,len(evaluated)):
+            ti,wi,parts_i,ri=evaluated[i]
+            tj,wj,parts_j,rj=evaluated[j]
+            if (wi==wj) or (parts_i!=parts_j) or (ri.shape!=rj.shape):
+                continue
+            with np.errstate(all='ignore'):
+                # NaN and inf are reported above and never count as agreeing
+                close=(np.isfinite(ri)&np.isfinite(rj)&(np.abs(ri-rj)<=tolerance*np.maximum(np.abs(ri),np.abs(rj)))).all(axis=0)
+            if close.any():
+                warnings.append("Answers "+ti+" ("+str(wi)+"%) and "+tj+" ("+str(wj)+"%) agree within tolerance for "
+                                +str(close.sum())+" of "+str(len(close))+" dataset items")
+    return warnings
 
 
 # In[31]:
@@ -1576,7 +2168,7 @@ def extract_question(quiz,q_text,I,var={},N=200):
                 case="0"
             WA=[r.split("+++") for r in extract_line(q_text,"ANSWER:")]
             #print(WA)
-            answers=[[r[1].strip(),float(r[0])] for r in WA]
+            answers=[Answer(r[1].strip(),float(r[0])) for r in WA]
             create_shortanswer(quiz,name,text,answers,case=case)
         elif q_type=='essay':
             create_essay(quiz,name,text)
@@ -1607,7 +2199,7 @@ def extract_question(quiz,q_text,I,var={},N=200):
             eq=extract_line(q_text,"EQUATION:")
             eq_str=str(eq)
             if len(eq)>1:
-                eq=[[(rr[1].strip()),float(rr[0].strip())]for rr in [r.split("+++") for r in eq]]
+                eq=[Answer(rr[1].strip(),float(rr[0].strip())) for rr in [r.split("+++") for r in eq]]
             else:
                 eq=eq[0]
             var_local=[]
@@ -1617,6 +2209,8 @@ def extract_question(quiz,q_text,I,var={},N=200):
                     var_local.append(var_[v])
                 except:
                     raise Exception('Variable undefined: '+v)
+            for w in check_calculated_answers(eq,var_local,q_type=q_type,tolerance=tol):
+                print("WARNING! ########################################################## "+name+": "+w)
             if q_type in ['calculated_simple','calculatedsimple']:
                 create_calculated_simple(quiz,name,text,eq,var_local,tolerance=tol,correctanswerlength=correctanswerlength)
             if q_type=='calculated':
@@ -1634,17 +2228,17 @@ def extract_question(quiz,q_text,I,var={},N=200):
                 single_answer=True
             WA=[r.split("+++") for r in extract_line(q_text,"ANSWER:")]
             #print(WA)
-            answers=[[r[1].strip(),float(r[0])] for r in WA]
+            answers=[Answer(r[1].strip(),float(r[0])) for r in WA]
             create_multichoice(quiz,name,text,answers,single_answer=single_answer,shuffle=shuffle)
         elif q_type=='truefalse':
             WA=[r.split("+++") for r in extract_line(q_text,"ANSWER:")]
             #print(WA)
-            answers=[[r[1].strip(),float(r[0])] for r in WA]
+            answers=[Answer(r[1].strip(),float(r[0])) for r in WA]
             create_truefalse(quiz,name,text,answers)
         elif q_type in ["missing_words",'gapselect','ddwtos']:
             if (q_type=='missing_words'):
                 q_type='gapselect'
-            wrong_answers=[[rr[0].strip(),rr[1].strip()]for rr in [r.split("+++") for r in extract_line(q_text,"CAT&WRONG_ANS:")]]
+            wrong_answers=[(rr[0].strip(),rr[1].strip()) for rr in [r.split("+++") for r in extract_line(q_text,"CAT&WRONG_ANS:")]]
             create_missing_words(quiz,name,text,wrong_answers,shuffle=shuffle,q_type=q_type)
         elif q_type=="numerical":
             try:
@@ -1657,14 +2251,12 @@ def extract_question(quiz,q_text,I,var={},N=200):
                 acc=DEFAULT_TOL
             answers=extract_line(q_text,"ANSWER:")
             if len(answers)>1:
-                answers=[[float(rr[1].strip()),float(rr[0].strip())]for rr in [r.split("+++") for r in answers]]
+                answers=[Answer(float(rr[1].strip()),float(rr[0].strip())) for rr in [r.split("+++") for r in answers]]
             else:
                 answers=float(answers[0])
             create_numerical(quiz,name,text,answers,tolerance=tol,accuracy=acc)
         elif q_type=="cloze":
-            text=evaluate_cloze_function(text,"MULTICHOICE")
-            text=evaluate_cloze_function(text,"NUMERICAL")
-            text=evaluate_cloze_function(text,"SHORTANSWER")
+            text=compile_cloze(text)
             create_cloze(quiz,name,text)
         else:
             raise Exception('Unknown question type: '+q_type)
@@ -1677,10 +2269,98 @@ def extract_question(quiz,q_text,I,var={},N=200):
 # In[32]:
 
 
-def text_to_xml(text,xml_file):
+import fnmatch
+
+def matches_any(value,patterns):
+    if not(patterns):
+        return True
+    for p in patterns:
+        if fnmatch.fnmatchcase(value,p):
+            return True
+    return False
+
+def select_questions(cat,categories=None,names=None):
+    """
+    Returns the blocks of cat (a list of question texts, possibly starting
+    with its category block) selected by the glob patterns in categories
+    and names. Only the NAME: lines are looked at.
+    """
+    if not(categories) and not(names):
+        return cat
+    has_category=(len(cat)>0) and (re.search("TYPE:[ \t]*category",cat[0]) is not None)
+    if (has_category):
+        try:
+            category=extract_line(cat[0],"NAME:")[0].replace("$course$/","")
+        except IndexError:
+            category=""
+        questions=cat[1:]
+    else:
+        category=""
+        questions=cat
+    includes=[q for q in questions if is_include_block(q)]
+    if not(matches_any(category,categories)):
+        return includes
+    selected=[]
+    for q in questions:
+        if is_include_block(q):
+            selected.append(q) # filtered in the included file
+            continue
+        try:
+            name=extract_line(q,"NAME:")[0]
+        except IndexError:
+            continue
+        if matches_any(name,names):
+            selected.append(q)
+    if (names) and (len(selected)==len(includes)):
+        return includes
+    if (has_category):
+        return [cat[0]]+selected
+    return selected
+
+def question_error(block,e,category=""):
+    q_type,name=text_question_fields(block)
+    return {'category':category,'name':name,'type':q_type,'block':block,'exception':type(e).__name__+": "+str(e)}
+
+def image_stamps(block):
+    """
+    Identifies the current version of the images block refers to, for
+    keying cached questions.
+    """
+    files=image_files.get()
+    stamps=[]
+    for m in image_link_re.finditer(block):
+        name=m.group(1).replace("$","SsS").replace(r"?","QqQ")
+        try:
+            if files is None:
+                st=os.stat(name)
+                stamps.append((name,st.st_mtime_ns,st.st_size))
+            elif hasattr(files,'stamp'):
+                stamps.append((name,files.stamp(name)))
+            elif type(files)==dict:
+                stamps.append((name,hash_bytes(files[name])))
+            else:
+                stamps.append((name,))
+        except (OSError,KeyError):
+            stamps.append((name,None))
+    return tuple(stamps)
+
+def text_to_xml(text,xml_file,categories=None,names=None,max_bytes=None,split_categories=False,errors=None,cache=None,writer=None,includes=None):
+    """
+    If errors is a list, a question that fails to compile is left out of the
+    output and recorded in errors instead of aborting the conversion. If
+    xml_file is None, the XML is returned as a string instead of written.
+    cache (a dict) keeps compiled questions and shared variables between
+    calls, keyed by their text, the SHARED_VARS of their category and the
+    images they use. writer (e.g. a PieceCollector) receives the questions
+    instead of xml_file, and includes returns the (xml,is_category) pieces
+    of the files named by INCLUDE: blocks.
+    """
     import re
     split="\n[ \t]*----------+\n"
     quiz=Ele('quiz')
+    sharded=(writer is None) and ((max_bytes) or (split_categories))
+    if (sharded):
+        writer=ShardedQuizWriter(xml_file,max_bytes=max_bytes,split_categories=split_categories)
     #create_category(quiz,extract_category(text))
     try:
         N_samples=int(extract_line(text,"N_SAMPLES:")[0])
@@ -1704,15 +2384,82 @@ def text_to_xml(text,xml_file):
                 CATs.append([re.split(split,Cs[i])[-1]+"TYPE: 			category"+re.split(split,Cs[i+1])[0]]+
                             re.split(split,Cs[i+1])[1:])
 
-    for cat in CATs:
+    with profile_stage('compile'):
+        text_to_xml_categories(quiz,CATs,N_samples,writer,categories,names,errors,cache,includes)
+    if writer is not None:
+        with profile_stage('serialize'):
+            filenames=writer.close()
+        if (sharded):
+            print("Wrote "+str(len(filenames))+" files: "+", ".join(filenames))
+        return filenames
+    elif quiz.find('include') is not None:
+        with profile_stage('serialize'):
+            xml="<quiz>"+"".join([x for x,is_category in serialize_elements(list(quiz),includes,{})])+"</quiz>"
+        if xml_file is None:
+            return xml
+        with open(xml_file,"w") as f:
+            f.write(xml)
+    elif xml_file is None:
+        with profile_stage('serialize'):
+            return element_to_xml(quiz)
+    else:
+        with profile_stage('serialize'):
+            write_quiz_to_file(quiz,xml_file)
+
+def text_to_xml_categories(quiz,CATs,N_samples,writer=None,categories=None,names=None,errors=None,cache=None,includes=None):
+    selections=[select_questions(cat,categories,names) for cat in CATs]
+    state={}
+    report_progress(total=sum([len(s) for s in selections]))
+    for cat,selected in zip(CATs,selections):
+        if len(selected)==0:
+            continue
         #print("\n".join(cat))
-        shared_vars=extract_vars("\n".join(cat),N_samples,shared=True) #separate shared variables in each category
+        category=text_question_fields(selected[0])[1] if re.search("TYPE:[ \t]*category",selected[0]) else ""
+        cat_key=hash_bytes((category+"\n"+"\n".join(extract_line("\n".join(cat),"SHARED_VARS:"))+"\n"+str(N_samples)).encode('utf-8'))
+        try:
+            shared_vars=None
+            if cache is not None:
+                shared_vars=cache.get(('vars',cat_key))
+            if shared_vars is None:
+                shared_vars=extract_vars("\n".join(cat),N_samples,shared=True) #separate shared variables in each category
+                if cache is not None:
+                    cache[('vars',cat_key)]=shared_vars
+        except Exception as e:
+            if errors is None:
+                raise
+            errors.append(question_error(selected[0],e,category))
+            shared_vars={}
         #print(str(shared_vars))
         i=1
-        for q in cat:
-            extract_question(quiz,q,i,shared_vars,N_samples)
+        for q in selected:
+            n=len(quiz)
+            key=None
+            cached=None
+            if (cache is not None) and not(is_include_block(q)):
+                key=(cat_key,hash_bytes(q.encode('utf-8')),image_stamps(q))
+                cached=cache.get(key)
+            if is_include_block(q):
+                for path in extract_line(q,"INCLUDE:"):
+                    Sub(quiz,'include').set('file',path)
+            elif cached is not None:
+                quiz.extend(cached)
+            else:
+                try:
+                    extract_question(quiz,q,i,shared_vars,N_samples)
+                    if key is not None:
+                        cache[key]=list(quiz)[n:]
+                except Exception as e:
+                    if errors is None:
+                        raise
+                    for el in list(quiz)[n:]:
+                        quiz.remove(el)
+                    errors.append(question_error(q,e,category))
             i+=1
-    write_quiz_to_file(quiz,xml_file)
+            report_progress(questions=1)
+            if writer is not None:
+                for xml,is_category in serialize_elements(list(quiz),includes,state):
+                    writer.add(xml,is_category=is_category)
+                quiz.clear()
 
 
 # # Sorting questions within category in text file
@@ -1720,44 +2467,149 @@ def text_to_xml(text,xml_file):
 # In[ ]:
 
 
+from natsort import natsort_keygen
+natsort_key=natsort_keygen()
+category_marker_re=re.compile("TYPE:[ \t]*category\n")
+
+def question_sort_key(block):
+    try:
+        return natsort_key(extract_line(block,"NAME:")[0])
+    except IndexError:
+        return natsort_key("")
+
 def sort_qs_in_text(text):
-    end=r"""
+    """
+    Sorts the questions of every category by the natural order of their
+    names. The text is split once; category blocks keep their place.
+    """
+    pieces=re.split(QUESTION_SPLIT,text)
+    out=[pieces[0]]
+    questions=[]
+    for piece in pieces[1:]:
+        m=category_marker_re.search(piece)
+        if m is None:
+            questions.append(piece)
+            continue
+        out.extend(sorted(questions,key=question_sort_key))
+        out.append(piece[:m.start()]+"TYPE: \t\t\tcategory\n"+piece[m.end():])
+        questions=[]
+    out.extend(sorted(questions,key=question_sort_key))
+    return QUESTION_END.join(out)
 
-   -------------------------------------------------------------
 
-"""
-    split="\n[ \t]*----------+\n"
-    import re
-    #quiz=re.split(split,text)[0]
-    Cs=re.split("TYPE:[ \t]*category\n",text)
-    quiz=re.split(split,text)[0]
-    categ=[]
-    if len(Cs)==1:
-        #CATs=re.split(split,Cs[0])
-        CATs=[re.split(split,Cs[0])[1:]]
-    else:
-        #CATs=[re.split(split,Cs[0])[:-1]]
-        CATs=[]
-        
-        for i in range(len(Cs)-1):
-            if (i<len(Cs)-2):
-                categ.append(re.split(split,Cs[i])[-1]+"TYPE: 			category\n"+re.split(split,Cs[i+1])[0])
-                CATs.append(
-                            re.split(split,Cs[i+1])[1:-1])
+# # Multi-file question banks
+
+# In[ ]:
+
+
+include_line_re=re.compile(r"(?m)^[ \t]*INCLUDE:")
+INCLUDE_MARKER="\x00INCLUDE:"
+
+def is_include_block(block):
+    """
+    A block with INCLUDE: lines and no TYPE: inserts the questions of the
+    Markdown files it names at its place.
+    """
+    return (include_line_re.search(block) is not None) and not("TYPE:" in block)
+
+def included_files(text):
+    paths=[]
+    for block in re.split(QUESTION_SPLIT,"\n"+text)[1:]:
+        if is_include_block(block):
+            paths.extend(extract_line(block,"INCLUDE:"))
+    return paths
+
+def directory_image_stamps(text,directory):
+    files=ImageFiles(directory)
+    return contextvars.copy_context().run(lambda: (image_files.set(files),image_stamps(text))[1])
+
+def _compile_included_file(args):
+    path,text,sort_questions,categories,names,keep_going=args
+    directory=os.path.dirname(path)
+    def marker(p):
+        return [(INCLUDE_MARKER+os.path.abspath(os.path.join(directory,p)),False)]
+    def run():
+        image_files.set(ImageFiles(directory))
+        errors=[] if keep_going else None
+        t="\n"+text # the file may start with a separator
+        if (sort_questions):
+            t=sort_qs_in_text(t)
+        pieces=text_to_xml(t,None,categories=categories,names=names,errors=errors,writer=PieceCollector(),includes=marker)
+        return pieces,errors
+    return contextvars.copy_context().run(run)
+
+class IncludedFiles(object):
+    """
+    Compiles the files named by the INCLUDE: blocks of a Markdown bank (and
+    those they include). Every file is compiled on its own, with its own
+    N_SAMPLES, categories and SHARED_VARS and with images relative to its
+    directory, and the files are compiled in parallel over jobs processes.
+    cache keeps the XML of every file by the hash of its text and images, so
+    a rebuild only compiles the files that changed. Called with a path
+    relative to base_dir, returns the (xml,is_category) pieces of the file.
+    """
+    def __init__(self,base_dir=".",cache=None,sort_questions=True,categories=None,names=None,errors=None,jobs=None):
+        self.base_dir=base_dir
+        self.cache={} if cache is None else cache
+        self.sort_questions=sort_questions
+        self.categories=categories
+        self.names=names
+        self.errors=errors
+        self.jobs=jobs
+        self.texts={}
+        self.keys={}
+
+    def _scan(self,path,stack):
+        if path in stack:
+            raise Exception("Circular INCLUDE: "+" -> ".join(stack+[path]))
+        if path in self.texts:
+            return
+        with open(path) as f:
+            text=f.read()
+        self.texts[path]=text
+        stamps=directory_image_stamps(text,os.path.dirname(path))
+        self.keys[path]=hash_bytes(json.dumps([text,stamps,self.sort_questions,self.categories,self.names,self.errors is not None]).encode('utf-8'))
+        for p in included_files(text):
+            self._scan(os.path.abspath(os.path.join(os.path.dirname(path),p)),stack+[path])
+
+    def prepare(self,text,path=None):
+        """
+        Compiles the files included by text (the bank in file path) that are
+        not in cache. Returns the number of files compiled.
+        """
+        for p in included_files(text):
+            self._scan(os.path.abspath(os.path.join(self.base_dir,p)),[] if path is None else [os.path.abspath(path)])
+        tasks=[(p,self.texts[p],self.sort_questions,self.categories,self.names,self.errors is not None)
+               for p in self.texts if self.cache.get(p,{}).get('key')!=self.keys[p]]
+        if (self.jobs==1) or (len(tasks)<2):
+            results=map(_compile_included_file,tasks)
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=self.jobs) as ex:
+                results=list(ex.map(_compile_included_file,tasks))
+        for task,(pieces,errors) in zip(tasks,results):
+            self.cache[task[0]]={'key':self.keys[task[0]],'pieces':pieces,'errors':errors or []}
+        for p in list(self.cache):
+            if not(p in self.keys):
+                del self.cache[p]
+        if self.errors is not None:
+            for p in self.keys:
+                for e in self.cache[p]['errors']:
+                    e=dict(e,file=p)
+                    e['line'],e['offset']=locate_block(self.texts[p],e.pop('block'))
+                    self.errors.append(e)
+        return len(tasks)
+
+    def pieces(self,path):
+        for xml,is_category in self.cache[path]['pieces']:
+            if xml.startswith(INCLUDE_MARKER):
+                for piece in self.pieces(xml[len(INCLUDE_MARKER):]):
+                    yield piece
             else:
-                categ.append(re.split(split,Cs[i])[-1]+"TYPE: 			category\n"+re.split(split,Cs[i+1])[0])
-                CATs.append(
-                            re.split(split,Cs[i+1])[1:])
-    #print(categ)
-    from natsort import natsorted
+                yield xml,bool(is_category)
 
-    for cat in CATs:
-        cat=natsorted(cat)
-        if len(categ)>0:
-            quiz+=end+categ.pop(0)
-        if len(cat)>0:
-            quiz+=end+end.join(cat)
-    return quiz
+    def __call__(self,path):
+        return self.pieces(os.path.abspath(os.path.join(self.base_dir,path)))
 
 
 # # XML to text
@@ -1777,51 +2629,159 @@ import urllib.parse
 def down_image(url):
     filename = url.split("/")[-1]
     filename=urllib.parse.unquote(filename, encoding='utf-8', errors='replace')
-    opener=urllib.request.build_opener()
-    opener.addheaders=[('User-Agent','Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1941.0 Safari/537.36')]
-    urllib.request.install_opener(opener)
-    urllib.request.urlretrieve(url, filename)
-    return filename
+    request=urllib.request.Request(url,headers={'User-Agent':'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1941.0 Safari/537.36'})
+    with urllib.request.urlopen(request) as response:
+        return filename,response.read()
+
+
+# In[ ]:
+
+
+import hashlib
+
+IMAGE_MIME_EXTENSIONS={'image/png':'png','image/jpeg':'jpg','image/jpg':'jpg','image/pjpeg':'jpg',
+                       'image/gif':'gif','image/svg+xml':'svg','image/webp':'webp','image/bmp':'bmp',
+                       'image/tiff':'tif','image/x-icon':'ico','image/vnd.microsoft.icon':'ico'}
+
+def safe_image_filename(filename):
+    return filename.replace("$","SsS").replace(r"?","QqQ")
+
+def hash_bytes(data):
+    return hashlib.sha1(data).hexdigest()
+
+class ImageStore(object):
+    """
+    Keeps track of the images extracted from an XML file by content hash.
+    Identical payloads are written only once and every question refers to
+    the same file. A payload whose name is already taken by different bytes
+    (in this run or on disk) is saved as name_<hash>.ext instead, so that
+    repeated exports produce identical file sets. If files (a dict) is given,
+    images are stored in it by name instead of being written to directory.
+    """
+    def __init__(self,directory=".",save=True,files=None):
+        self.directory=directory
+        self.save=save
+        self.files=files
+        self.names={}  # filename -> content hash
+        self.hashes={} # content hash -> filename
+
+    def _disk_hash(self,filename):
+        if self.files is not None:
+            return hash_bytes(self.files[filename]) if filename in self.files else None
+        path=os.path.join(self.directory,filename)
+        if not os.path.isfile(path):
+            return None
+        with open(path,"rb") as fh:
+            return hash_bytes(fh.read())
+
+    def _free(self,filename,h):
+        if filename in self.names:
+            return self.names[filename]==h
+        disk=self._disk_hash(filename)
+        return (disk is None) or (disk==h)
+
+    def add(self,filename,data,write=None):
+        if write is None:
+            write=self.save
+        filename=safe_image_filename(filename)
+        report_progress(image_bytes=len(data))
+        h=hash_bytes(data)
+        if h in self.hashes:
+            return self.hashes[h]
+        name=filename
+        if not self._free(name,h):
+            stem,ext=os.path.splitext(filename)
+            name=stem+"_"+h[:10]+ext
+            i=1
+            while not self._free(name,h):
+                name=stem+"_"+h[:10]+"_"+str(i)+ext
+                i+=1
+            print("##################################### WARNING: A different image with the name "+filename+" already exists. Saving to: "+name)
+        if write and (self.files is not None):
+            self.files[name]=data
+        elif write and self._disk_hash(name)!=h:
+            with open(os.path.join(self.directory,name),"wb") as fh:
+                fh.write(data)
+        self.names[name]=h
+        self.hashes[h]=name
+        return name
+
+    def add_base64(self,filename,b64,write=None):
+        return self.add(filename,base64.decodebytes(b64.encode('utf-8')),write=write)
+
+    def add_data_uri(self,mime,b64,write=None):
+        data=base64.decodebytes(b64.encode('utf-8'))
+        ext=IMAGE_MIME_EXTENSIONS.get(mime.lower().strip(),mime.split("/")[-1].split("+")[0])
+        return self.add("img_"+hash_bytes(data)[:12]+"."+ext,data,write=write)
+
+
+data_uri_img_re = re.compile(r'(<img\b[^>]*?\bsrc=")data:([^;",]+);base64,([^"]*)(")')
+
+def extract_data_uri_images(text,images,q_name=""):
+    def replace(m):
+        filename=images.add_data_uri(m.group(2),m.group(3))
+        if not(images.save):
+            print("##################################### WARNING: An image file was extracted from xml but not saved. In text file it appears as: "+filename)
+            print("##################################### WARNING: You will need to manually check the following question: " + q_name)
+        return m.group(1)+filename+m.group(4)
+    return data_uri_img_re.sub(replace,text)
 
 
 # In[35]:
 
 
 def returnOrder(e):
-    return e['order']
+    return e.order
 def returnName(e):
-    return e['name']
+    return e.name
 
 
 # In[36]:
 
 
-from decimal import Decimal
 def count_sigfigs(numstr):
-    if type(numstr)==list:
-        return [len(Decimal(n).normalize().as_tuple().digits) for n in numstr]
-    else:
-        return len(Decimal(numstr).normalize().as_tuple().digits)
+    """
+    Number of significant digits of a number string, or an array of them
+    for a list of strings (trailing zeros of integers do not count, as with
+    Decimal.normalize()).
+    """
+    s=np.char.lower(np.char.strip(np.atleast_1d(np.asarray(numstr,dtype=str))))
+    digits=np.char.replace(np.char.partition(s,'e')[...,0],'.','')
+    digits=np.char.strip(np.char.lstrip(digits,'+-'),'0')
+    n=np.maximum(np.char.str_len(digits),1)
+    if type(numstr) in [list,np.ndarray]:
+        return n
+    return int(n[0])
+
+def dataset_values(v):
+    """
+    Parses the dataset items of the dataset definition v once: returns the
+    value strings and their float array.
+    """
+    items=v['dataset_items']['dataset_item']
+    if type(items)==dict:
+        items=[items]
+    strs=[a['value'] for a in items]
+    return strs,np.array(strs,dtype=float)
 #np.max(count_sigfigs([str(0.1),str(0.0021)]))
 
 
 # In[ ]:
 
 
-def dict_to_md_ddimageortext(doc):
+def dict_to_md_ddimageortext(doc,images=None):
     dg=doc['drag']
     if type(dg)==dict:
         dg=[dg]
-    images = [doc]+dg
-    if images is not None:
-        for image in images:
-            try:
-                img_name = image['file']['@name'].replace("$","SsS").replace(r"?","QqQ")
-                img_data = image['file']['#text']
-                with open( img_name, 'wb') as f:
-                    f.write(base64.decodebytes(img_data.encode('utf-8')))
-            except:
-                continue
+    if images is None:
+        images=ImageStore()
+    renamed={}
+    for image in [doc]+dg:
+        try:
+            img_name = safe_image_filename(image['file']['@name'])
+            renamed[img_name]=images.add_base64(img_name,image['file']['#text'],write=True)
+        except:
+            continue
 
 
     drag_choices = doc['drag']
@@ -1837,7 +2797,7 @@ def dict_to_md_ddimageortext(doc):
             inf='No'
         try:
             choices.append({
-                'filename': drag_choice['file']['@name'].replace("$","SsS").replace(r"?","QqQ"),
+                'filename': renamed[safe_image_filename(drag_choice['file']['@name'])],
                 'group' : str(drag_choice['draggroup']),
                 'text' : 'nOtHiNgHeRE',
                 'location' : [],
@@ -1858,7 +2818,7 @@ def dict_to_md_ddimageortext(doc):
     for drop_answer in drop_answers:
         choices[-1+int(drop_answer['choice'])]['location'].append([drop_answer['xleft'],drop_answer['ytop']])
 
-    main_image_filename = doc['file']['@name'].replace("$","SsS").replace(r"?","QqQ")
+    main_image_filename = renamed[safe_image_filename(doc['file']['@name'])]
     #Converting XML to Markdown
     markdown_text = '   ![](' + main_image_filename + ')\n\n'
     markdown_text += '   | Drop Location | Drag Group | Drag Content | Unlimited Use? |\n'
@@ -1887,8 +2847,12 @@ def dict_to_md_ddimageortext(doc):
     markdown_text += '\n\n'
 
     markdown_text += "   %%% Below is a preview that works in Ghostwriter. Not needed when creating a question.\n\n"
+    markdown_text += ddimageortext_overlay(main_image_filename,choices)
     
-    markdown_text += '   <div style="position: relative;">\n'
+    return markdown_text
+
+def ddimageortext_overlay(main_image_filename,choices):
+    markdown_text = '   <div style="position: relative;">\n'
     markdown_text += '   <img src="'+main_image_filename+'"  />\n'
     for c in choices:
         for i in range(len(c['location'])):
@@ -1905,20 +2869,19 @@ def dict_to_md_ddimageortext(doc):
 # In[ ]:
 
 
-def dict_to_md_ddmarker(doc):
+def dict_to_md_ddmarker(doc,images=None):
     dg=doc['drag']
     if type(dg)==dict:
         dg=[dg]
-    images = [doc]+dg
-    if images is not None:
-        for image in images:
-            try:
-                img_name = image['file']['@name'].replace("$","SsS").replace(r"?","QqQ")
-                img_data = image['file']['#text']
-                with open( img_name, 'wb') as f:
-                    f.write(base64.decodebytes(img_data.encode('utf-8')))
-            except:
-                continue
+    if images is None:
+        images=ImageStore()
+    renamed={}
+    for image in [doc]+dg:
+        try:
+            img_name = safe_image_filename(image['file']['@name'])
+            renamed[img_name]=images.add_base64(img_name,image['file']['#text'],write=True)
+        except:
+            continue
 
 
     drag_choices = doc['drag']
@@ -1946,7 +2909,7 @@ def dict_to_md_ddmarker(doc):
         choices[-1+int(drop_answer['choice'])]['shape'].append(drop_answer['shape'])
         choices[-1+int(drop_answer['choice'])]['coords'].append(drop_answer['coords'])
 
-    main_image_filename = doc['file']['@name'].replace("$","SsS").replace(r"?","QqQ")
+    main_image_filename = renamed[safe_image_filename(doc['file']['@name'])]
     #Converting XML to Markdown
     markdown_text = '   ![](' + main_image_filename + ')\n\n'
     markdown_text += '   | Drop Shape | Drop Coords | Drag Content | Use # of times (Inf for $\infty$) |\n'
@@ -1969,8 +2932,12 @@ def dict_to_md_ddmarker(doc):
     markdown_text += '\n\n'
 
     markdown_text += "   %%% Below is a preview that works in Ghostwriter. Not needed when creating a question.\n\n"
+    markdown_text += ddmarker_overlay(main_image_filename,choices)
     
-    markdown_text += '   <div style="position: relative;">\n'
+    return markdown_text
+
+def ddmarker_overlay(main_image_filename,choices):
+    markdown_text = '   <div style="position: relative;">\n'
     markdown_text += '   <img src="'+main_image_filename+'"  />\n'
     for c in choices:
         for i in range(len(c['shape'])):
@@ -2005,470 +2972,2188 @@ def dict_to_md_ddmarker(doc):
 
 
 def xml_to_text_deal_with_dollar_signs(text):
-    text=re.sub(r'([^\$])\$([^\$])', r"\1DOLLAR_SIGN\2", text)
-    if len(text)>=2 and text[-1]=="\$" and  text[-2]!="\$":
-        text=text[:-1]+"DOLLAR_SIGN"
-    text=text.replace(r"\(","$").replace(r"\)","$")
-    text=text.replace("$$","$")
-    text=text.replace("$$","$")
-    return text
+    return "$".join(math_tokens(text,moodle=True))
 
 
 # In[1]:
 
 
 import base64
-import time
 import html
 
-def xml_to_text(quiz,MARKDOWNIFY=False,save_images=True,fix_ranges_from_database=False):
-    TEXT=""
-    codespace ="       "    
-    end=r"""
+CODESPACE="       "
+QUESTION_END=r"""
 
    -------------------------------------------------------------
 
 """
-    Qs=[]
-    qQz=quiz['question']
-    #print(qQz)
-    if type(qQz)==dict:
-        qQz=[qQz]
-    for q in qQz:
-        #print(q)
-        try:
+QUESTION_SPLIT="\n[ \t]*----------+\n"
+
+def xml_question_to_dict(q,MARKDOWNIFY=False,fix_ranges_from_database=False,images=None):
+    if images is None:
+        images=ImageStore()
+    try:
+        q_name=q['name']['text']
+    except:
+        None
+   
+    q_type= q['@type']
+    if q_type=="category":
+        text=""
+        q_name=q['category']['text'].split("$/")[-1]
+    else:
+        text=q['questiontext']['text']
+
+    renamed={}
+    try:
+        img_data=q['questiontext']
+        if type(img_data)==dict:
+            img_data=[img_data]
+        for img in img_data:
+            im=img['file']
+            if type(im)==dict:
+                im=[im]
+            for i in im:
+                try:
+                    filename=safe_image_filename(i['@name'].decode('ASCII'))
+                except:
+                    filename=safe_image_filename(i['@name'])
+                renamed[filename]=images.add_base64(filename,i['#text'])
+    except:
+        None
+
+    text=extract_data_uri_images(text,images,q_name)
+    
+    
+    
+    img_tags=extract_arg_of_function2(text,r"",brackets=[r"<img",r">"])
+    for im in img_tags:
+        filename=extract_arg_of_function2(im,r"src=",brackets=[r'"',r'"'])
+        if valid_url(filename[0]):
+            oldf=filename[0]
+            filename,data=down_image(oldf)
+            if not(filename.split(r".")[-1] in ["png","gif"]):
+                from PIL import Image
+                import io
+                png=io.BytesIO()
+                Image.open(io.BytesIO(data)).save(png,format="PNG")
+                data=png.getvalue()
+                filename=filename+".png"
+                filename=urllib.parse.unquote(filename, encoding='utf-8', errors='replace')
+            filename=images.add(filename,data,write=True)
             try:
-                q_name=q['name']['text']
+                width=extract_arg_of_function2(im,r"width=",brackets=['"','"'])
+                text=text.replace(r"<img"+im+r">",r"![]("+filename+r"){width="+width[0]+r"}")
             except:
-                None
-           
-            q_type= q['@type']
-            if q_type=="category":
-                text=""
-                q_name=q['category']['text'].split("$/")[-1]
-            else:
-                text=q['questiontext']['text']
-        
+                text=text.replace(r"<img"+im+r">",r"![]("+filename+r")")
+        else:
+            fn=urllib.parse.unquote(filename[0].replace(r"@@PLUGINFILE@@/",""), encoding='utf-8', errors='replace')
+            fn=fn.replace("$","SsS").split(r"?time")[0].replace(r"?","QqQ")
+            fn=renamed.get(fn,fn)
             try:
-                img_data=q['questiontext']
-                if type(img_data)==dict:
-                    img_data=[img_data]
-                for img in img_data:
-                    im=img['file']
-                    if type(im)==dict:
-                        im=[im]
-                    for i in im:
-                        try:
-                            filename=i['@name'].decode('ASCII').replace("$","SsS").replace(r"?","QqQ")
-                        except:
-                            filename=i['@name'].replace("$","SsS").replace(r"?","QqQ")
-                        if (save_images):
-                            #print(img)
-                            if (os.path.isfile(filename)):
-                                filename+=str(time.clock_gettime(0)).replace("$","SsS").replace(r"?","QqQ")
-                                print("##################################### WARNING: An image file with this name already exists. Saving to: "+filename)
-                                print("##################################### WARNING: You will need to manually check the following question: " + q_name)
-                            with open(filename, "wb") as fh:
-                                fh.write(base64.decodebytes(i['#text'].encode('utf-8')))
+                width=extract_arg_of_function2(im,r"width=",brackets=['"','"'])
+                text=text.replace(r"<img"+im+r">",r"![]("+fn+r"){width="+width[0]+r"}")
             except:
-                None
+                text=text.replace(r"<img"+im+r">",r"![]("+fn+r")")
 
-            
-            img_data=extract_arg_of_function2(text,r"""<img src="data:image/png;ba""",brackets=["se64,","\""])
-            for img in img_data:
-                filename=("img_"+str(time.clock_gettime(0))+".png")
-                filename=filename.replace("$","SsS").replace(r"?","QqQ")
-                if (save_images):
-                    with open(filename, "wb") as fh:
-                        fh.write(base64.decodebytes(img.encode('utf-8')))
-                else:
-                    print("##################################### WARNING: An image file was extracted from xml but not saved. In text file it appears as: "+filename)
-                    print("##################################### WARNING: You will need to manually check the following question: " + q_name)
-                text=text.replace(r"""<img src="data:image/png;base64,"""+img+"\"","<img src=\""+filename+"\"")
-            
-            
-            
-            images=extract_arg_of_function2(text,r"",brackets=[r"<img",r">"])
-            for im in images:
-                filename=extract_arg_of_function2(im,r"src=",brackets=[r'"',r'"'])
-                if valid_url(filename[0]):
-                    oldf=filename[0]
-                    filename=down_image(oldf)
-                    if not(filename.split(r".")[-1] in ["png","gif"]):
-                        from PIL import Image
-                        img = Image.open(filename)
-                        filename=filename+".png"
-                        filename=urllib.parse.unquote(filename, encoding='utf-8', errors='replace')
-                        img.save(filename)
-                    try:
-                        width=extract_arg_of_function2(im,r"width=",brackets=['"','"'])
-                        text=text.replace(r"<img"+im+r">",r"![]("+filename+r"){width="+width[0]+r"}")
-                    except:
-                        text=text.replace(r"<img"+im+r">",r"![]("+filename+r")")
-                else:
-                    fn=urllib.parse.unquote(filename[0].replace(r"@@PLUGINFILE@@/",""), encoding='utf-8', errors='replace')
-                    fn=fn.replace("$","SsS").split(r"?time")[0].replace(r"?","QqQ")
-                    try:
-                        width=extract_arg_of_function2(im,r"width=",brackets=['"','"'])
-                        text=text.replace(r"<img"+im+r">",r"![]("+fn+r"){width="+width[0]+r"}")
-                    except:
-                        text=text.replace(r"<img"+im+r">",r"![]("+fn+r")")
-        
-            
-            text=text.replace("\n"," ")
-            text=text.replace("  +"," ")
-            text=text.replace("\t+"," ")
-            #text=text.replace(r"<span>"," ")
-            #text=text.replace(r"</span>"," ")
-            if not(MARKDOWNIFY):
-                text=text.replace("</p>","\n\n")
-                text=text.replace("<p>","")
-                text=text.replace("<br>","\n\n")
-                text=text.replace("<br />","\n\n")
-            text=re.sub("\n\n+","\n\n",text).strip()
+    
+    text=text.replace("\n"," ")
+    text=text.replace("  +"," ")
+    text=text.replace("\t+"," ")
+    #text=text.replace(r"<span>"," ")
+    #text=text.replace(r"</span>"," ")
+    if not(MARKDOWNIFY):
+        text=text.replace("</p>","\n\n")
+        text=text.replace("<p>","")
+        text=text.replace("<br>","\n\n")
+        text=text.replace("<br />","\n\n")
+    text=re.sub("\n\n+","\n\n",text).strip()
+
+    text=xml_to_text_deal_with_dollar_signs(text)
+    if (MARKDOWNIFY):
+        text=markdownify(text,escape_underscores=False,escape_asterisks=False)
+    
+    text = "\n".join([s.strip() for s in text.split("\n")])
+    text=text.replace("\n.\n","\n\n")
+    text=re.sub("\n\n+","\n\n",text).strip()
+    
+    text = "\n   ".join([s.strip() for s in text.split("\n")])
+    text="   "+text
         
-            text=xml_to_text_deal_with_dollar_signs(text)
-            if (MARKDOWNIFY):
-                text=markdownify(text,escape_underscores=False,escape_asterisks=False)
-            
-            text = "\n".join([s.strip() for s in text.split("\n")])
-            text=text.replace("\n.\n","\n\n")
-            text=re.sub("\n\n+","\n\n",text).strip()
-            
-            text = "\n   ".join([s.strip() for s in text.split("\n")])
-            text="   "+text
-                
+    try:
+        shuffle=q['shuffleanswers']
+        #print(str(shuffle))
+        if shuffle in ["false","False","FALSE","0",0]:
+            shuffle=False
+        else:
+            shuffle=True
+        #print(str(q['shuffleanswers'])+" "+str(shuffle)+" "+q_name)
+    except:
+        shuffle=True
+    
+    if q_type=='ddimageortext':
+        return DragDropQuestion(q_type,q_name,text,drag_drop=dict_to_md_ddimageortext(q,images),shuffle=shuffle)
+    elif q_type=='ddmarker':
+        showmisplaced=False
+        if 'showmisplaced' in q:
+            showmisplaced=True
+        return DragDropQuestion(q_type,q_name,text,drag_drop=dict_to_md_ddmarker(q,images),shuffle=shuffle,showmisplaced=showmisplaced)
+    elif q_type in ['description','cloze','essay','category']:
+        #Qs.append([q_type,q_name,text])
+        return Question(q_type,q_name,text) #cloze/description
+    elif q_type=='randomsamatch':
+        return RandomMatchQuestion(q_type,q_name,text,choose=q['choose'],subcats=q['subcats'])
+    elif q_type =='shortanswer':
+        if q['usecase'].strip() in ["0","False","false","FALSE",0]:
+            case="0"
+        else:
+            case="1"
+        answers=[]
+        qq=q['answer']
+        if type(qq)==dict:
+            qq=[qq]
+        for sub in qq:
+                answer=sub['text']
+                fraction=sub['@fraction']
+                answers.append(Answer(answer,float(fraction)))
+        return ShortAnswerQuestion(q_type,q_name,text,case=case,answers=answers)
+    elif q_type in ['calculated','calculatedsimple','calculatedmulti']:
+        #sync=q.find('./synchronize').text
+        answers=[]
+        qq=q['answer']
+        if type(qq)==dict:
+            qq=[qq]
+        for sub in qq:
+                #Sub(a,'tolerance').text=str(tolerance)
+                #Sub(a,'tolerancetype').text=tolerancetype  #1=relative (set default) 2=nominal
+                #Sub(a,'correctanswerformat').text=correctanswerformat # 2=sigfigs (set default) 1=decimals
+                #Sub(a,'correctanswerlength').text=correctanswerlength
+                try:
+                    correctanswerlength=int(sub['correctanswerlength'])
+                except:
+                    correctanswerlength=3
+                answer=sub['text']
+                tolerance=abs(float(sub['tolerance']))
+                fraction=float(sub['@fraction'])
+                answers.append(CalculatedAnswer(answer,fraction,tolerance,correctanswerlength))
+        #answer=q.find('./answer/text').text
+        vs=q['dataset_definitions']['dataset_definition']
+        if type(vs)==dict:
+            vs=[vs]
+        var=[]
+        for v in vs:
+            #print(v['status'])
+            s=v['status']['text']
+            shared=False
+            if s=='shared':
+                shared=True
+            name=v['name']['text']
+            minmax=[float(v['minimum']['text']),float(v['maximum']['text'])]
+            #print(v.find('decimals/text'))
+            decimals=round(float(v['decimals']['text']))
+            count=int(v['itemcount'])
+            #print(name+'   '+q_name+"   "+str([a for a in v.findall('./dataset_items/')]))
+            try:
+                strs,values=dataset_values(v)
+                sigfigs=(np.max(count_sigfigs(strs)))
+            except:
+                values=None
+                sigfigs=1000
+            if (fix_ranges_from_database):
+                minmax_from_data=[np.min(values),np.max(values)]
+                if (minmax[0]>minmax_from_data[0]) or (minmax[1]<minmax_from_data[1]):
+                    print("############ WARNING!!! Mismatch between data min/max and declared m/m in q: "+q_name+" var: "+name+" ["+str(floor_to_sigfigs(minmax_from_data[0],2))
+                         +", "+str(ceil_to_sigfigs(minmax_from_data[1],2))+"]")
+                    minmax=[floor_to_sigfigs(minmax_from_data[0],2),ceil_to_sigfigs(minmax_from_data[1],2)]
+                elif (minmax[0]==1.) and (minmax[1]==10.):
+                    minmax=[floor_to_sigfigs(minmax_from_data[0],2),ceil_to_sigfigs(minmax_from_data[1],2)]
+                if np.abs(minmax[1]-minmax[0])<1.e-100:
+                    minmax[1]=minmax[0]+0.01*np.abs(minmax[1])
+                    print("############ WARNING!!! min=max in q: "+q_name+" var: "+name)
+                    
             try:
-                shuffle=q['shuffleanswers']
-                #print(str(shuffle))
-                if shuffle in ["false","False","FALSE","0",0]:
-                    shuffle=False
+                expression=v['expression']['text'].replace(r"<![CDATA[","").replace(r"]]>","")
+                if len(expression)>0:
+                    order=int(v['order'])
                 else:
-                    shuffle=True
-                #print(str(q['shuffleanswers'])+" "+str(shuffle)+" "+q_name)
+                    order=0
             except:
-                shuffle=True
-            
-            if q_type=='ddimageortext':
-                Qs.append({'type':q_type,'name':q_name,'text':text,'drag-drop': dict_to_md_ddimageortext(q),'shuffle':shuffle}) 
-            elif q_type=='ddmarker':
-                showmisplaced=False
-                if 'showmisplaced' in q:
-                    showmisplaced=True
-                Qs.append({'type':q_type,'name':q_name,'text':text,'drag-drop': dict_to_md_ddmarker(q),'shuffle':shuffle,'showmisplaced':showmisplaced}) 
-            elif q_type in ['description','cloze','essay','category']:
-                #Qs.append([q_type,q_name,text])
-                Qs.append({'type':q_type,'name':q_name,'text':text}) #cloze/description
-            elif q_type=='randomsamatch':
-                Qs.append({'type':q_type,'name':q_name,'text':text,'choose':q['choose'],'subcats':q['subcats']})
-            elif q_type =='shortanswer':
-                if q['usecase'].strip() in ["0","False","false","FALSE",0]:
-                    case="0"
+                expression=''
+                order=0
+            var.append(Variable(name,minmax,decimals,shared=shared,order=order,expression=expression,sigfigs=sigfigs))
+        #Qs.append([q_type,q_name,text,var,answers])
+        return CalculatedQuestion(q_type,q_name,text,var=var,answers=answers)#calculated/calculatedsimple
+    elif q_type=='matching':
+        QA=[]
+        qq=q['subquestion']
+        if type(qq)==dict:
+            qq=[qq]
+        for sub in qq:
+                question=sub['text'].replace('<p dir="ltr" style="text-align: left;">','')
+                answer=sub['answer']['text'].replace('<p dir="ltr" style="text-align: left;">','')
+                question=xml_to_text_deal_with_dollar_signs(question)
+                answer=xml_to_text_deal_with_dollar_signs(answer)
+                QA.append((question.replace(r"<p>","").replace(r"</p>","").replace(r"<br>",""),answer.replace(r"<p>","").replace(r"</p>","").replace(r"<br>","")))
+        #Qs.append([q_type,q_name,text,QA,shuffle])
+        return MatchingQuestion(q_type,q_name,text,QA=QA,shuffle=shuffle)#matching
+    elif q_type in ['multichoice','truefalse']:
+        if (q_type!='truefalse'):
+            if (q['single'].strip() in ["true","True","TRUE","1"]):
+                single_answer=True
+            else:
+                single_answer=False
+        else:
+            single_answer=True
+        answers=[]
+        qq=q['answer']
+        if type(qq)==dict:
+            qq=[qq]
+        for sub in qq:
+                answer=sub['text'].replace('<p dir="ltr" style="text-align: left;">','')
+                answer=xml_to_text_deal_with_dollar_signs(answer)
+                fraction=sub['@fraction']
+                answers.append(Answer(answer.replace("<p>","").replace("</p>","").replace("<br>",""),float(fraction)))
+        #Qs.append([q_type,q_name,text,answers,single_answer,shuffle])
+        return MultichoiceQuestion(q_type,q_name,text,answers=answers,single_answer=single_answer,shuffle=shuffle)#multichoice
+    elif q_type in ['gapselect','ddwtos']:
+        answers=[]
+        try:
+            qq=q['selectoption']
+        except:
+            qq=q['dragbox']
+        if type(qq)==dict:
+            qq=[qq]
+        for sub in qq:
+                ans=sub['text']
+                ans=xml_to_text_deal_with_dollar_signs(ans)
+                group=sub['group']
+                if 'infinite' in sub:
+                    group+='U'
+                answers.append((group,ans))
+        z=extract_arg_of_function(text,"\[",brackets=["[","]]"])
+        correct_answers=[]
+        for zz in z:
+            try:
+                correct_answers.append(int(zz)-1)
+            except:
+                continue
+        correct_answers=list(set(correct_answers))
+        correct_answers.sort()
+        correct_answers.reverse()
+        for i in correct_answers:
+            a=answers.pop(i)
+            text=text.replace("[["+str(i+1)+"]]","[["+a[0]+"@"+a[1]+"]]")
+        #print(answers)
+        wrong_answers=answers
+        #Qs.append([q_type,q_name,text,wrong_answers,shuffle])
+        return GapselectQuestion(q_type,q_name,text,wrong_answers=wrong_answers,shuffle=shuffle)#gapselect
+        #print(str(shuffle)+" "+q_name+" 1111")
+    elif q_type=='numerical':
+        answers=[]
+        qq=q['answer']
+        if type(qq)==dict:
+            qq=[qq]
+        for sub in qq:
+                answer=float(sub['text'])
+                tol=float(sub['tolerance'])
+                fraction=float(sub['@fraction'])
+                if abs(answer)<1.e-200:
+                    tol=0.01
                 else:
-                    case="1"
-                answers=[]
-                qq=q['answer']
-                if type(qq)==dict:
-                    qq=[qq]
-                for sub in qq:
-                        answer=sub['text']
-                        fraction=sub['@fraction']
-                        answers.append([answer,float(fraction)])
-                Qs.append({'type':q_type,'name':q_name,'text':text,'case':case,'answers':answers})
-            elif q_type in ['calculated','calculatedsimple','calculatedmulti']:
-                #sync=q.find('./synchronize').text
-                answers=[]
-                qq=q['answer']
-                if type(qq)==dict:
-                    qq=[qq]
-                for sub in qq:
-                        #Sub(a,'tolerance').text=str(tolerance)
-                        #Sub(a,'tolerancetype').text=tolerancetype  #1=relative (set default) 2=nominal
-                        #Sub(a,'correctanswerformat').text=correctanswerformat # 2=sigfigs (set default) 1=decimals
-                        #Sub(a,'correctanswerlength').text=correctanswerlength
-                        try:
-                            correctanswerlength=int(sub['correctanswerlength'])
-                        except:
-                            correctanswerlength=3
-                        answer=sub['text']
-                        tolerance=abs(float(sub['tolerance']))
-                        fraction=float(sub['@fraction'])
-                        answers.append([answer,fraction,tolerance,correctanswerlength])
-                #answer=q.find('./answer/text').text
-                vs=q['dataset_definitions']['dataset_definition']
-                if type(vs)==dict:
-                    vs=[vs]
-                var=[]
-                for v in vs:
-                    #print(v['status'])
-                    s=v['status']['text']
-                    shared=False
-                    if s=='shared':
-                        shared=True
-                    name=v['name']['text']
-                    minmax=[float(v['minimum']['text']),float(v['maximum']['text'])]
-                    #print(v.find('decimals/text'))
-                    decimals=round(float(v['decimals']['text']))
-                    count=int(v['itemcount'])
-                    #print(name+'   '+q_name+"   "+str([a for a in v.findall('./dataset_items/')]))
-                    try:
-                        sigfigs=(np.max(count_sigfigs([a['value'] for a in v['dataset_items']['dataset_item']])))
-                    except:
-                        sigfigs=1000
-                    if (fix_ranges_from_database):
-                        minmax_from_data=[(np.min(([float(a['value']) for a in v['dataset_items']['dataset_item']]))),(np.max(([float(a['value']) for a in v['dataset_items']['dataset_item']])))]
-                        if (minmax[0]>minmax_from_data[0]) or (minmax[1]<minmax_from_data[1]):
-                            print("############ WARNING!!! Mismatch between data min/max and declared m/m in q: "+q_name+" var: "+name+" ["+str(floor_to_sigfigs(minmax_from_data[0],2))
-                                 +", "+str(ceil_to_sigfigs(minmax_from_data[1],2))+"]")
-                            minmax=[floor_to_sigfigs(minmax_from_data[0],2),ceil_to_sigfigs(minmax_from_data[1],2)]
-                        elif (minmax[0]==1.) and (minmax[1]==10.):
-                            minmax=[floor_to_sigfigs(minmax_from_data[0],2),ceil_to_sigfigs(minmax_from_data[1],2)]
-                        if np.abs(minmax[1]-minmax[0])<1.e-100:
-                            minmax[1]=minmax[0]+0.01*np.abs(minmax[1])
-                            print("############ WARNING!!! min=max in q: "+q_name+" var: "+name)
-                            
-                    try:
-                        expression=v['expression']['text'].replace(r"<![CDATA[","").replace(r"]]>","")
-                        if len(expression)>0:
-                            order=int(v['order'])
-                            var.append({'name':name,'minmax':minmax,'decimals':decimals,'shared':shared,'expression':expression,'order':order,'sigfigs':sigfigs})
-                        else:
-                            var.append({'name':name,'minmax':minmax,'decimals':decimals,'shared':shared,'order':0,'sigfigs':sigfigs})
-                    except:
-                        var.append({'name':name,'minmax':minmax,'decimals':decimals,'shared':shared,'order':0,'sigfigs':sigfigs})
-                #Qs.append([q_type,q_name,text,var,answers])
-                Qs.append({'type':q_type,'name':q_name,'text':text,'var':var,'answers':answers})#calculated/calculatedsimple
-            elif q_type=='matching':
-                QA=[]
-                qq=q['subquestion']
-                if type(qq)==dict:
-                    qq=[qq]
-                for sub in qq:
-                        question=sub['text'].replace('<p dir="ltr" style="text-align: left;">','')
-                        answer=sub['answer']['text'].replace('<p dir="ltr" style="text-align: left;">','')
-                        question=xml_to_text_deal_with_dollar_signs(question)
-                        answer=xml_to_text_deal_with_dollar_signs(answer)
-                        QA.append([question.replace(r"<p>","").replace(r"</p>","").replace(r"<br>",""),answer.replace(r"<p>","").replace(r"</p>","").replace(r"<br>","")])
-                #Qs.append([q_type,q_name,text,QA,shuffle])
-                Qs.append({'type':q_type,'name':q_name,'text':text,'QA':QA,'shuffle':shuffle})#matching
-            elif q_type in ['multichoice','truefalse']:
-                if (q_type!='truefalse'):
-                    if (q['single'].strip() in ["true","True","TRUE","1"]):
-                        single_answer=True
-                    else:
-                        single_answer=False
+                    tol=abs(tol/(answer))
+                answers.append(NumericalAnswer(answer,fraction,tol))
+        return NumericalQuestion(q_type,q_name,text,answers=answers)#numerical
+    else:
+        raise Exception("Unknown category: "+q_type)
+
+
+def question_dict_to_text(q,shared_vars,MARKDOWNIFY=False,fix_ranges_from_database=False):
+    # The shared variables declared here are only added to shared_vars once
+    # the question rendered, so a failed question does not hide them.
+    declared=[]
+    TEXT=""
+    if ((q.type)=='category'):
+        nc=q.name.count('/')+1
+        leading_symbol="#"*nc
+    else:
+        leading_symbol="1."
+        
+    TEXT+=leading_symbol + " NAME: 			"+q.name+"\n\n"
+    TEXT+=CODESPACE + "TYPE: 			"+q.type+"\n\n"
+    if q.type=='category':
+        del shared_vars[:]
+    if q.type=='ddimageortext':
+        TEXT+=CODESPACE + "SHUFFLE: 		" + str(q.shuffle)+"\n\n"
+    if q.type=='ddmarker':
+        TEXT+=CODESPACE + "SHUFFLE: 		" + str(q.shuffle)+"\n\n"
+        TEXT+=CODESPACE + "SHOWMISPLACED: 		" + str(q.showmisplaced)+"\n\n"
+        #TEXT+=CODESPACE + "DRAG_DROP:\n"+q.drag_drop+"\n\n"
+    if q.type in ['calculated','calculatedsimple','calculatedmulti']:
+        #print(q.var)
+        q.var.sort(key=returnName)
+        q.var.sort(key=returnOrder) 
+        #print(q.var)
+        for qvar in q.var:
+            if qvar.shared:
+                if (qvar.name in shared_vars) or (qvar.name in declared):
+                    continue
                 else:
-                    single_answer=True
-                answers=[]
-                qq=q['answer']
-                if type(qq)==dict:
-                    qq=[qq]
-                for sub in qq:
-                        answer=sub['text'].replace('<p dir="ltr" style="text-align: left;">','')
-                        answer=xml_to_text_deal_with_dollar_signs(answer)
-                        fraction=sub['@fraction']
-                        answers.append([answer.replace("<p>","").replace("</p>","").replace("<br>",""),float(fraction)])
-                #Qs.append([q_type,q_name,text,answers,single_answer,shuffle])
-                Qs.append({'type':q_type,'name':q_name,'text':text,'answers':answers,'single_answer':single_answer,'shuffle':shuffle})#multichoice
-            elif q_type in ['gapselect','ddwtos']:
-                answers=[]
-                try:
-                    qq=q['selectoption']
-                except:
-                    qq=q['dragbox']
-                if type(qq)==dict:
-                    qq=[qq]
-                for sub in qq:
-                        ans=sub['text']
-                        ans=xml_to_text_deal_with_dollar_signs(ans)
-                        group=sub['group']
-                        if 'infinite' in sub:
-                            group+='U'
-                        answers.append([group,ans])
-                z=extract_arg_of_function(text,"\[",brackets=["[","]]"])
-                correct_answers=[]
-                for zz in z:
-                    try:
-                        correct_answers.append(int(zz)-1)
-                    except:
-                        continue
-                correct_answers=list(set(correct_answers))
-                correct_answers.sort()
-                correct_answers.reverse()
-                for i in correct_answers:
-                    a=answers.pop(i)
-                    text=text.replace("[["+str(i+1)+"]]","[["+a[0]+"@"+a[1]+"]]")
-                #print(answers)
-                wrong_answers=answers
-                #Qs.append([q_type,q_name,text,wrong_answers,shuffle])
-                Qs.append({'type':q_type,'name':q_name,'text':text,'wrong_answers':wrong_answers,'shuffle':shuffle})#gapselect
-                #print(str(shuffle)+" "+q_name+" 1111")
-            elif q_type=='numerical':
-                answers=[]
-                qq=q['answer']
-                if type(qq)==dict:
-                    qq=[qq]
-                for sub in qq:
-                        answer=float(sub['text'])
-                        tol=float(sub['tolerance'])
-                        fraction=float(sub['@fraction'])
-                        if abs(answer)<1.e-200:
-                            tol=0.01
-                        else:
-                            tol=abs(tol/(answer))
-                        answers.append([answer,fraction,tol])
-                Qs.append({'type':q_type,'name':q_name,'text':text,'answers':answers})#numerical
+                    declared.append(qvar.name)
+                TEXT+=CODESPACE + 'SHARED_VARS:		'
             else:
-                raise Exception("Unknown category: "+q_type)
-        except:
-            raise
-            #continue
-    TEXT+=codespace + "N_SAMPLES:		200\n"
+                TEXT+=CODESPACE + 'PRIVATE_VARS:		'
+            mm=qvar.minmax
+            if (fix_ranges_from_database):
+                if (np.abs(mm[0])>1.e-100): # and (np.abs(mm[1])>1.e-100):
+                    #sigfigs=round(1+np.floor(np.log10(max(abs(mm[0]),np.sqrt(abs(mm[1]))))))+qvar.decimals
+                    sigfigs=round(1+np.floor(1.e-4+np.log10(abs(mm[0]))))+qvar.decimals
+                elif  np.abs(mm[1])>1.e-100:
+                    sigfigs=round(1+np.floor(np.log10((abs(mm[1])))))+qvar.decimals
+                else:
+                    sigfigs=qvar.decimals
+            else:             
+                sigfigs=round(1+np.floor(np.log10(max(abs(mm[0]),abs(mm[1])))))+qvar.decimals
+            if (qvar.sigfigs==1000):
+                if abs(qvar.sigfigs-sigfigs)>1:
+                    sigfigs=min(qvar.sigfigs,sigfigs)
+                if (fix_ranges_from_database):
+                    if sigfigs==0:
+                        sigfigs=1
+                    if sigfigs<0: # fix broken sigfigs
+                        sigfigs*=-1
+            else:
+                sigfigs=qvar.sigfigs
+            if len(qvar.expression)>0:
+                sss=qvar.expression
+            else:
+                sss=str(qvar.minmax)
+            if (sigfigs!=3):
+                TEXT+=qvar.name+"={"+sss+" sigfigs:"+str(sigfigs)+"};\n\n"
+            else:
+                TEXT+=qvar.name+"="+sss+";\n\n"
+        if len(q.answers)==1:
+            TEXT+=CODESPACE + "EQUATION: 		"+q.answers[0][0]+"\n\n"
+        else:
+            for eq in q.answers:
+                TEXT+=CODESPACE + "EQUATION: 		"+str(eq[1])+"  +++  "+eq[0]+"\n\n"
+        TEXT+=CODESPACE + "TOLERANCE: 		"+str(q.answers[0][2])+"\n\n"
+        if q.answers[0][3]!=3:
+            TEXT+=CODESPACE + "SIGFIGS: 		"+str(q.answers[0][3])+"\n\n"           
+    if q.type in ['gapselect','ddwtos']:
+        TEXT+=CODESPACE + "SHUFFLE: 		" + str(q.shuffle)+"\n\n"
+        #print(q.wrong_answers)
+        for w in q.wrong_answers:
+            TEXT+=CODESPACE + "CAT&WRONG_ANS:  "+w[0]+"  +++  "+w[1]+"\n\n"
+    if q.type=='numerical':
+        if len(q.answers)==1:
+            TEXT+=CODESPACE + "ANSWER: 		"+str(q.answers[0][0])+"\n\n"
+            if q.answers[0][0]==0.0:
+                TEXT+=CODESPACE + "ACCURACY: 		"+str(0.001)+"\n\n"
+        else:
+            for w in q.answers:
+                TEXT+=CODESPACE + "ANSWER:  "+str(w[1])+"  +++  "+str(w[0])+"\n\n"
+                if w[0]==0.0:
+                    TEXT+=CODESPACE + "ACCURACY: 		"+str(0.001)+"\n\n"
+    if q.type=='matching':
+        TEXT+=CODESPACE + "SHUFFLE: 		" + str(q.shuffle)+"\n\n"
+        for w in q.QA:
+            TEXT+=CODESPACE + "Q&A:  "+w[0]+" +++ "+w[1]+"\n\n"
+    if q.type=='multichoice':
+        TEXT+=CODESPACE + "SHUFFLE: 		" + str(q.shuffle)+"\n\n"
+        TEXT+=CODESPACE + "SINGLE_ANSWER_Q: 		" + str(q.single_answer)+"\n\n"
+        if len(q.answers)==1:
+            TEXT+=CODESPACE + "ANSWER:		"+q.answers[0]+"\n\n"
+        else:
+            for w in q.answers:
+                TEXT+=CODESPACE + "ANSWER:		"+str(w[1])+" +++ "+w[0]+"\n\n"
+    if q.type=='truefalse':
+        if len(q.answers)==1:
+            TEXT+=CODESPACE + "ANSWER:		"+q.answers[0]+"\n\n"
+        else:
+            for w in q.answers:
+                TEXT+=CODESPACE + "ANSWER:		"+str(w[1])+" +++ "+w[0]+"\n\n"
+    if q.type=='shortanswer':
+        TEXT+=CODESPACE + "CASE: 		" + q.case+"\n\n"
+        #if len(q.answers)==1:
+        #    TEXT+="ANSWER:		"+q.answers[0]+"\n"
+        #else:
+        for w in q.answers:
+            TEXT+=CODESPACE + "ANSWER:		"+str(w[1])+" +++ "+w[0]+"\n\n"
+    if q.type=='randomsamatch':
+        if q.subcats in ['1','True','TRUE','true']:
+            TEXT+=CODESPACE + "SUBCATS:		True\n\n"
+        else:
+            TEXT+=CODESPACE + "SUBCATS:		False\n\n"
+        TEXT+=CODESPACE + "CHOOSE:		"+q.choose+"\n\n"
+            
+    if (MARKDOWNIFY):
+        TEXT += CODESPACE + "MARKDOWN\n\n"
+    #tt=re.sub("\n\n+","\n\n",tt).strip()
+    #tt=tt.replace(r"&nbsp;"," ")
+    #tt=tt.replace(r"&#160;"," ")
+    #tt=tt.replace(r"&#8217;","'")
+    #tt=urllib.parse.unquote(tt, encoding='utf-8', errors='replace')
+    TEXT += CODESPACE + "TEXT:\n\n"+q.text+"\n"
     
-    #print(Qs)
+    if q.type in ['ddimageortext','ddmarker']:
+        #TEXT+=CODESPACE + "SHUFFLE: 		" + str(q.shuffle)+"\n\n"
+        #TEXT+=CODESPACE + "SHOWMISPLACED: 		" + str(q.showmisplaced)+"\n\n"
+        TEXT+="\n"+CODESPACE + "DRAG_DROP:\n\n"+q.drag_drop+"\n\n"
     
+    TEXT = "\n".join([s.rstrip() for s in TEXT.split("\n")])
+    TEXT=TEXT.replace("\n.\n","\n\n")
+    TEXT=re.sub("\n\n+","\n\n",TEXT).rstrip()
+    shared_vars.extend(declared)
+    return html.unescape(TEXT)
+
+
+class RecordingImageStore(ImageStore):
+    """
+    Stands in for the ImageStore in worker processes: every image is recorded
+    and gets a placeholder name, which the parent replaces by the name its
+    ImageStore gives the image when the records are replayed in order.
+    """
+    def __init__(self):
+        ImageStore.__init__(self,save=False)
+        self.added=[]
+
+    def add(self,filename,data,write=None):
+        self.added.append((filename,data,write))
+        return "MOODLEMDIMAGE"+str(len(self.added)-1)+"X"
+
+image_placeholder_re=re.compile(r"MOODLEMDIMAGE(\d+)X")
+
+def _xml_question_model(args):
+    images=RecordingImageStore()
+    try:
+        return xml_question_to_dict(*args,images=images),None,images.added
+    except Exception as e:
+        return None,e,images.added
+
+def xml_question_models(qQz,MARKDOWNIFY=False,fix_ranges_from_database=False,images=None,jobs=None):
+    """
+    Yields (model,exception,image_names) for every question of qQz, in order.
+    With jobs>1 the questions are converted in that many processes; their
+    images are then added to images here, in order, so the names are the
+    same as in a serial run, and image_names lists the name of each
+    placeholder. Serially image_names is None.
+    """
+    if (jobs is None) or (jobs==1) or (len(qQz)<2):
+        for q in qQz:
+            try:
+                yield xml_question_to_dict(q,MARKDOWNIFY=MARKDOWNIFY,fix_ranges_from_database=fix_ranges_from_database,images=images),None,None
+            except Exception as e:
+                yield None,e,None
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs) as ex:
+        tasks=((q,MARKDOWNIFY,fix_ranges_from_database) for q in qQz)
+        for qd,e,added in ex.map(_xml_question_model,tasks,chunksize=max(1,len(qQz)//(4*jobs))):
+            yield qd,e,[images.add(filename,data,write=write) for filename,data,write in added]
+
+def xml_to_text(quiz,MARKDOWNIFY=False,save_images=True,fix_ranges_from_database=False,images=None,errors=None,jobs=None):
+    if images is None:
+        images=ImageStore(save=save_images)
+    qQz=quiz['question']
+    if type(qQz)==dict:
+        qQz=[qQz]
+    TEXT=[CODESPACE + "N_SAMPLES:		200"]
     shared_vars=[]
-    
-    for q in Qs:
-        if ((q['type'])=='category'):
-            nc=q['name'].count('/')+1
-            leading_symbol="#"*nc
+    question_error=XMLQuestionErrors(qQz)
+    report_progress(total=len(qQz))
+    # Every question is written out as soon as it is read, so only one
+    # question model is alive at a time. The shared variables of a category
+    # are written once, so this part stays in order in this process.
+    models=xml_question_models(qQz,MARKDOWNIFY=MARKDOWNIFY,fix_ranges_from_database=fix_ranges_from_database,images=images,jobs=jobs)
+    for i,(qd,e,names) in enumerate(models):
+        try:
+            if e is not None:
+                raise e
+            text=question_dict_to_text(qd,shared_vars,MARKDOWNIFY=MARKDOWNIFY,fix_ranges_from_database=fix_ranges_from_database)
+            if names:
+                text=image_placeholder_re.sub(lambda m: names[int(m.group(1))],text)
+            TEXT.append(QUESTION_END+text)
+        except Exception as e:
+            if errors is None:
+                raise
+            errors.append(question_error(i,e))
+        report_progress(questions=1)
+    return "".join(TEXT)
+
+class XMLQuestionErrors(object):
+    """
+    Describes the failures of the questions of qQz, with the category they
+    are in and their position in the file. The fields and keys of the
+    questions are computed once, at the first failure.
+    """
+    def __init__(self,qQz):
+        self.qQz=qQz
+        self.fields=None
+
+    def __call__(self,i,e):
+        if self.fields is None:
+            self.fields=[]
+            for q in self.qQz:
+                try:
+                    self.fields.append(xml_question_fields(q))
+                except Exception:
+                    self.fields.append(("",""))
+            self.keys=list(question_keys(self.fields))
+        return {'category':self.keys[i][0],'name':self.fields[i][1],'type':self.fields[i][0],'question':i,'exception':type(e).__name__+": "+str(e)}
+
+
+# # Incremental xml->text sync
+
+# In[ ]:
+
+
+import json
+
+def split_text_pieces(text):
+    """
+    Splits a Markdown question bank at the question separators without
+    losing any characters: the first piece is the header and every other
+    piece starts with its separator, so "".join(pieces)==text.
+    """
+    pieces=[]
+    last=0
+    for m in re.finditer(QUESTION_SPLIT,text):
+        pieces.append(text[last:m.start()])
+        last=m.start()
+    pieces.append(text[last:])
+    return pieces
+
+def question_keys(fields):
+    """
+    Turns a sequence of (type,name) pairs into (category,name,n) keys that
+    identify questions across files. Category blocks get the name None, n
+    counts repeated names within a category and unparsable blocks get None.
+    """
+    category=""
+    seen={}
+    for q_type,name in fields:
+        if q_type is None:
+            yield None
+            continue
+        if q_type=='category':
+            category=name
+            key=(category,None)
         else:
-            leading_symbol="1."
-            
-        TEXT+=end
-        #Qs.append({'type':q_type,'name':q_name,'text':text,'answers':answers,'single_answer':single_answer,'shuffle':shuffle})#multichoice
-        TEXT+=leading_symbol + " NAME: 			"+q['name']+"\n\n"
-        TEXT+=codespace + "TYPE: 			"+q['type']+"\n\n"
-        if q['type']=='category':
-            shared_vars=[]
-        if q['type']=='ddimageortext':
-            TEXT+=codespace + "SHUFFLE: 		" + str(q['shuffle'])+"\n\n"
-        if q['type']=='ddmarker':
-            TEXT+=codespace + "SHUFFLE: 		" + str(q['shuffle'])+"\n\n"
-            TEXT+=codespace + "SHOWMISPLACED: 		" + str(q['showmisplaced'])+"\n\n"
-            #TEXT+=codespace + "DRAG_DROP:\n"+q['drag-drop']+"\n\n"
-        if q['type'] in ['calculated','calculatedsimple','calculatedmulti']:
-            #print(q['var'])
-            q['var'].sort(key=returnName)
-            q['var'].sort(key=returnOrder) 
-            #print(q['var'])
-            for qvar in q['var']:
-                if qvar['shared']:
-                    if qvar['name'] in shared_vars:
+            key=(category,name)
+        n=seen.get(key,0)
+        seen[key]=n+1
+        yield key+(n,)
+
+def text_question_fields(piece):
+    try:
+        return (extract_line(piece,"TYPE:")[0],extract_line(piece,"NAME:")[0])
+    except IndexError:
+        return (None,None)
+
+def xml_question_fields(q):
+    if q['@type']=='category':
+        return ('category',html.unescape(q['category']['text'].split("$/")[-1]).strip())
+    try:
+        return (q['@type'],html.unescape(q['name']['text']).strip())
+    except:
+        return (q['@type'],"")
+
+def hash_xml_question(q,MARKDOWNIFY=False,fix_ranges_from_database=False):
+    return hash_bytes(json.dumps([MARKDOWNIFY,fix_ranges_from_database,q],sort_keys=True).encode('utf-8'))
+
+def xml_question_hashes(quiz,MARKDOWNIFY=False,fix_ranges_from_database=False):
+    qQz=quiz['question']
+    if type(qQz)==dict:
+        qQz=[qQz]
+    return dict((key,hash_xml_question(q,MARKDOWNIFY,fix_ranges_from_database))
+                for key,q in zip(question_keys([xml_question_fields(q) for q in qQz]),qQz))
+
+def declared_shared_vars(piece):
+    names=[]
+    for line in extract_line(piece,"SHARED_VARS:"):
+        for v in line.split(";"):
+            if "=" in v:
+                names.append(v.split("=")[0].strip())
+    return names
+
+def insert_shared_vars(block,declarations):
+    """
+    Adds a SHARED_VARS: line with the declarations ("name=value") to block,
+    in front of its TEXT:.
+    """
+    i=block.find("TEXT:")
+    if i<0:
+        i=len(block)
+    return block[:i]+"SHARED_VARS:\t\t"+"; ".join(declarations)+";\n\n       "+block[i:]
+
+def sync_xml_to_text(quiz,old_text,old_hashes=None,MARKDOWNIFY=False,save_images=True,fix_ranges_from_database=False,sort_questions=False,images=None,errors=None):
+    """
+    Updates the Markdown old_text to match quiz. Questions are matched by
+    category and name; only questions whose source hash differs from
+    old_hashes are converted again. Untouched blocks are kept byte for byte,
+    new questions are added to their category (in sorted position if
+    sort_questions) and questions that are no longer in quiz are removed.
+    Returns the new text and the hashes of all questions in quiz. If errors
+    is a list, questions that fail to convert keep their old block (and get
+    no hash, so they are retried next time) and are recorded in errors.
+    The SHARED_VARS declared by a removed question are moved to the next
+    remaining question of its category, unless declared there already.
+    """
+    if old_hashes is None:
+        old_hashes={}
+    if images is None:
+        images=ImageStore(save=save_images)
+    qQz=quiz['question']
+    if type(qQz)==dict:
+        qQz=[qQz]
+    hashes=xml_question_hashes(quiz,MARKDOWNIFY,fix_ranges_from_database)
+    entries=list(zip(hashes.keys(),qQz))
+
+    if old_text.strip()=="":
+        old_text=CODESPACE + "N_SAMPLES:		200"
+    pieces=split_text_pieces(old_text)
+    old_keys=list(question_keys([text_question_fields(p) for p in pieces[1:]]))
+    old={}
+    for i,key in enumerate(old_keys):
+        if key is not None:
+            old[key]=pieces[i+1]
+
+    kept=set(key for key,q in entries if (key in old) and (old_hashes.get(key)==hashes[key]))
+    declared={}
+    for key in kept:
+        declared.setdefault(key[0],[]).extend(declared_shared_vars(old[key]))
+
+    blocks={}
+    failed=set()
+    shared_vars=[]
+    question_error=XMLQuestionErrors(qQz)
+    report_progress(total=len(entries))
+    for i,(key,q) in enumerate(entries):
+        if not(key in kept):
+            try:
+                qd=xml_question_to_dict(q,MARKDOWNIFY=MARKDOWNIFY,fix_ranges_from_database=fix_ranges_from_database,images=images)
+                blocks[key]=question_dict_to_text(qd,shared_vars,MARKDOWNIFY=MARKDOWNIFY,fix_ranges_from_database=fix_ranges_from_database)
+            except Exception as e:
+                if errors is None:
+                    raise
+                errors.append(question_error(i,e))
+                failed.add(key)
+        if key[1] is None:
+            shared_vars[:]=declared.get(key[0],[])
+        report_progress(questions=1)
+
+    lead,trail=QUESTION_END[1:],"\n"
+    for key,piece in zip(old_keys,pieces[1:]):
+        if (key is not None) and (key[1] is not None):
+            lead=re.match(QUESTION_SPLIT+r"\s*",piece).group(0)
+            trail=piece[len(piece.rstrip()):] or trail
+            break
+
+    new_pieces=[pieces[0]]
+    keys=[None]
+    removed=0
+    orphans={}  # category -> SHARED_VARS declarations of removed questions
+    targets=[]  # (key of the question taking them,declarations)
+    for key,piece in zip(old_keys,pieces[1:]):
+        if (key is not None) and (key[1] is not None) and (key[0] in orphans) and (key in hashes):
+            targets.append((key,orphans.pop(key[0])))
+        if key is None:
+            new_pieces.append(piece)
+        elif not(key in hashes):
+            removed+=1
+            for line in extract_line(piece,"SHARED_VARS:"):
+                orphans.setdefault(key[0],[]).extend([v.strip() for v in line.split(";") if "=" in v])
+            continue
+        elif key in blocks:
+            m=re.match(QUESTION_SPLIT+r"\s*",piece)
+            new_pieces.append(m.group(0)+blocks.pop(key)+piece[len(piece.rstrip()):])
+        else:
+            new_pieces.append(piece)
+        keys.append(key)
+    added=len(blocks)
+    for key,q in entries:
+        if not(key in blocks):
+            continue
+        i=len(new_pieces)
+        in_category=[j for j in range(len(keys)) if (keys[j] is not None) and (keys[j][0]==key[0])]
+        if (key[1] is not None) and (len(in_category)>0):
+            i=in_category[-1]+1
+            if (sort_questions):
+                for j in in_category:
+                    if (keys[j][1] is not None) and (natsort_key(keys[j][1])>natsort_key(key[1])):
+                        i=j
+                        break
+        piece=lead+blocks.pop(key)+trail
+        if not(new_pieces[i-1].endswith("\n")):
+            new_pieces[i-1]+=trail
+        new_pieces.insert(i,piece)
+        keys.insert(i,key)
+    for category,declarations in orphans.items():
+        in_category=[k for k in keys if (k is not None) and (k[0]==category) and (k[1] is not None)]
+        if len(in_category)>0:
+            targets.append((in_category[-1],declarations))
+    for key,declarations in targets:
+        declared=set()
+        for k,piece in zip(keys,new_pieces):
+            if (k is not None) and (k[0]==key[0]):
+                declared.update(declared_shared_vars(piece))
+        declarations=[v for v in declarations if not(v.split("=")[0].strip() in declared)]
+        if len(declarations)>0:
+            j=keys.index(key)
+            new_pieces[j]=insert_shared_vars(new_pieces[j],declarations)
+    print("Sync: "+str(len(kept))+" questions unchanged, "+str(len(entries)-len(kept)-added-len(failed))+" updated, "
+          +str(added)+" added, "+str(removed)+" removed.")
+    for key in failed:
+        del hashes[key]
+    return "".join(new_pieces),hashes
+
+def read_sync_hashes(filename):
+    if not(os.path.isfile(filename)):
+        return {}
+    with open(filename) as f:
+        return dict(((e[0],e[1],e[2]),e[3]) for e in json.load(f))
+
+def write_sync_hashes(hashes,filename):
+    with open(filename,"w") as f:
+        json.dump([list(key)+[h] for key,h in hashes.items()],f,indent=0)
+
+
+# # Question index
+
+# In[ ]:
+
+
+xml_question_start_re = re.compile(rb'<question\b[^>]*>')
+xml_question_type_re = re.compile(rb'\btype="([^"]*)"')
+xml_category_re = re.compile(rb'<category>\s*<text>(.*?)</text>',re.DOTALL)
+xml_name_re = re.compile(rb'<name>\s*<text>(.*?)</text>',re.DOTALL)
+
+def xml_text_value(b):
+    t=b.decode('utf-8',errors='replace').strip()
+    if t.startswith("<![CDATA[") and t.endswith("]]>"):
+        return t[9:-3]
+    return html.unescape(t)
+
+def index_text_bank(data):
+    """
+    Finds the question blocks of a Markdown bank (bytes) using the same
+    separators as sort_qs_in_text. Returns a list of dicts with category,
+    name, type, hash, and the byte offset and length of every block.
+    """
+    spans=[]
+    last=None
+    for m in re.finditer(QUESTION_SPLIT.encode('utf-8'),data):
+        if last is not None:
+            spans.append((last,m.start()))
+        last=m.end()
+    if last is not None:
+        spans.append((last,len(data)))
+    fields=[text_question_fields(data[a:b].decode('utf-8',errors='replace')) for a,b in spans]
+    index=[]
+    for key,(q_type,name),(a,b) in zip(question_keys(fields),fields,spans):
+        if key is None:
+            continue
+        index.append({'category':key[0],'name':name,'type':q_type,'hash':hash_bytes(data[a:b]),'offset':a,'length':b-a})
+    return index
+
+def index_xml_bank(data):
+    """
+    Same as index_text_bank for a Moodle XML file (bytes); each entry covers
+    one <question>...</question> element.
+    """
+    spans=[]
+    fields=[]
+    pos=0
+    while True:
+        m=xml_question_start_re.search(data,pos)
+        if m is None:
+            break
+        b=data.find(b'</question>',m.end())
+        if b<0:
+            break
+        b+=len(b'</question>')
+        block=data[m.start():b]
+        t=xml_question_type_re.search(m.group(0))
+        q_type=t.group(1).decode('utf-8') if t else ""
+        if q_type=='category':
+            n=xml_category_re.search(block)
+            name=xml_text_value(n.group(1)).split("$/")[-1].strip() if n else ""
+        else:
+            n=xml_name_re.search(block)
+            name=xml_text_value(n.group(1)).strip() if n else ""
+        spans.append((m.start(),b))
+        fields.append((q_type,name))
+        pos=b
+    index=[]
+    for key,(q_type,name),(a,b) in zip(question_keys(fields),fields,spans):
+        index.append({'category':key[0],'name':name,'type':q_type,'hash':hash_bytes(data[a:b]),'offset':a,'length':b-a})
+    return index
+
+def index_filename(filename):
+    return filename+".idx.json"
+
+def build_index(filename):
+    with open(filename,"rb") as f:
+        data=f.read()
+    if filename[-3:]=="xml":
+        index=index_xml_bank(data)
+    else:
+        index=index_text_bank(data)
+    st=os.stat(filename)
+    with open(index_filename(filename),"w") as f:
+        json.dump({'file':os.path.basename(filename),'size':st.st_size,'mtime':st.st_mtime,'questions':index},f,indent=0)
+    return index
+
+def load_index(filename):
+    """
+    Returns the index of filename, rebuilding the sidecar if it is missing
+    or was built for a different version of the file.
+    """
+    try:
+        with open(index_filename(filename)) as f:
+            idx=json.load(f)
+        st=os.stat(filename)
+        if (idx['size']==st.st_size) and (idx['mtime']==st.st_mtime):
+            return idx['questions']
+    except (OSError,ValueError,KeyError):
+        None
+    return build_index(filename)
+
+def find_in_index(index,category=None,name=None):
+    return [e for e in index if ((category is None) or (e['category']==category)) and ((name is None) or (e['name']==name))]
+
+def read_indexed_question(filename,entry):
+    with open(filename,"rb") as f:
+        f.seek(entry['offset'])
+        return f.read(entry['length']).decode('utf-8')
+
+
+# # Question store (SQLite)
+
+# In[ ]:
+
+
+import sqlite3
+
+shared_vars_line_re=re.compile(r"(?m)^[ \t]*SHARED_VARS:.*\n?")
+
+STORE_SCHEMA="""
+CREATE TABLE IF NOT EXISTS sources(path TEXT PRIMARY KEY, hash TEXT, header TEXT);
+CREATE TABLE IF NOT EXISTS categories(source TEXT, name TEXT, block TEXT, shared_vars TEXT, PRIMARY KEY(source,name));
+CREATE TABLE IF NOT EXISTS questions(id INTEGER PRIMARY KEY, source TEXT, category TEXT, name TEXT, type TEXT, hash TEXT, block TEXT);
+CREATE INDEX IF NOT EXISTS questions_source ON questions(source);
+CREATE INDEX IF NOT EXISTS questions_hash ON questions(hash);
+CREATE TABLE IF NOT EXISTS images(hash TEXT PRIMARY KEY, data BLOB);
+CREATE TABLE IF NOT EXISTS question_images(question INTEGER, name TEXT, hash TEXT);
+CREATE INDEX IF NOT EXISTS question_images_question ON question_images(question);
+CREATE VIRTUAL TABLE IF NOT EXISTS question_text USING fts5(name, category, type, body);
+"""
+
+class QuestionStore(object):
+    """
+    A SQLite database of questions from many banks: one row per question
+    holding its Markdown block, a full-text (FTS5) index over the name,
+    category, type and text of every question, and the images stored once
+    by content hash. XML and .mbz files are converted with xml_to_text when
+    they are added; Markdown blocks are stored as they are. Any selection of
+    questions can be exported back to Markdown or Moodle XML. The
+    SHARED_VARS declared in every category are kept with the category, so
+    that exported questions can use them without the questions declaring
+    them.
+    """
+    def __init__(self,filename):
+        self.filename=filename
+        self.db=sqlite3.connect(filename)
+        self.db.executescript(STORE_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _remove_source(self,source):
+        ids=[(i,) for (i,) in self.db.execute("SELECT id FROM questions WHERE source=?",(source,))]
+        self.db.executemany("DELETE FROM question_text WHERE rowid=?",ids)
+        self.db.executemany("DELETE FROM question_images WHERE question=?",ids)
+        self.db.execute("DELETE FROM questions WHERE source=?",(source,))
+        self.db.execute("DELETE FROM categories WHERE source=?",(source,))
+        self.db.execute("DELETE FROM sources WHERE path=?",(source,))
+
+    def add_text(self,text,source,files=None,base_dir="."):
+        """
+        Stores the questions of the Markdown text under the name source,
+        replacing those stored before under that name. Images are read from
+        files (a dict filename -> bytes) or from base_dir. Returns the number
+        of questions stored.
+        """
+        with self.db:
+            self._remove_source(source)
+            self.db.execute("INSERT INTO sources VALUES (?,?,?)",(source,hash_bytes(text.encode('utf-8')),split_text_pieces(text)[0]))
+            n=0
+            shared={}
+            category_blocks={}
+            for line,category,block in text_blocks(text):
+                if is_include_block(block):
+                    continue
+                shared.setdefault(category,[]).extend(extract_line(block,"SHARED_VARS:"))
+                if re.search("TYPE:[ \t]*category",block):
+                    category_blocks[category]=block
+                    continue
+                q_type,name=text_question_fields(block)
+                cur=self.db.execute("INSERT INTO questions(source,category,name,type,hash,block) VALUES (?,?,?,?,?,?)",
+                                    (source,category,name,q_type,hash_bytes(block.strip().encode('utf-8')),block))
+                qid=cur.lastrowid
+                self.db.execute("INSERT INTO question_text(rowid,name,category,type,body) VALUES (?,?,?,?,?)",(qid,name,category,q_type,block))
+                for link in set(image_link_re.findall(block)):
+                    filename=safe_image_filename(link)
+                    try:
+                        if files is not None:
+                            data=files[filename]
+                        else:
+                            with open(os.path.join(base_dir,filename),"rb") as f:
+                                data=f.read()
+                    except (KeyError,OSError):
+                        print("##################################### WARNING: Image not found: "+filename+" in question "+str(name))
                         continue
-                    else:
-                        shared_vars.append(qvar['name'])
-                    TEXT+=codespace + 'SHARED_VARS:		'
-                else:
-                    TEXT+=codespace + 'PRIVATE_VARS:		'
-                mm=qvar['minmax']
-                if (fix_ranges_from_database):
-                    if (np.abs(mm[0])>1.e-100): # and (np.abs(mm[1])>1.e-100):
-                        #sigfigs=round(1+np.floor(np.log10(max(abs(mm[0]),np.sqrt(abs(mm[1]))))))+qvar['decimals']
-                        sigfigs=round(1+np.floor(1.e-4+np.log10(abs(mm[0]))))+qvar['decimals']
-                    elif  np.abs(mm[1])>1.e-100:
-                        sigfigs=round(1+np.floor(np.log10((abs(mm[1])))))+qvar['decimals']
-                    else:
-                        sigfigs=qvar['decimals']
-                else:             
-                    sigfigs=round(1+np.floor(np.log10(max(abs(mm[0]),abs(mm[1])))))+qvar['decimals']
-                if (qvar['sigfigs']==1000):
-                    if abs(qvar['sigfigs']-sigfigs)>1:
-                        sigfigs=min(qvar['sigfigs'],sigfigs)
-                    if (fix_ranges_from_database):
-                        if sigfigs==0:
-                            sigfigs=1
-                        if sigfigs<0: # fix broken sigfigs
-                            sigfigs*=-1
-                else:
-                    sigfigs=qvar['sigfigs']
-                try:
-                    sss=qvar['expression']
-                except:
-                    sss=str(qvar['minmax'])
-                if (sigfigs!=3):
-                    TEXT+=qvar['name']+"={"+sss+" sigfigs:"+str(sigfigs)+"};\n\n"
-                else:
-                    TEXT+=qvar['name']+"="+sss+";\n\n"
-            if len(q['answers'])==1:
-                TEXT+=codespace + "EQUATION: 		"+q['answers'][0][0]+"\n\n"
-            else:
-                for eq in q['answers']:
-                    TEXT+=codespace + "EQUATION: 		"+str(eq[1])+"  +++  "+eq[0]+"\n\n"
-            TEXT+=codespace + "TOLERANCE: 		"+str(q['answers'][0][2])+"\n\n"
-            if q['answers'][0][3]!=3:
-                TEXT+=codespace + "SIGFIGS: 		"+str(q['answers'][0][3])+"\n\n"           
-        if q['type'] in ['gapselect','ddwtos']:
-            TEXT+=codespace + "SHUFFLE: 		" + str(q['shuffle'])+"\n\n"
-            #print(q['wrong_answers'])
-            for w in q['wrong_answers']:
-                TEXT+=codespace + "CAT&WRONG_ANS:  "+w[0]+"  +++  "+w[1]+"\n\n"
-        if q['type']=='numerical':
-            if len(q['answers'])==1:
-                TEXT+=codespace + "ANSWER: 		"+str(q['answers'][0][0])+"\n\n"
-                if q['answers'][0][0]==0.0:
-                    TEXT+=codespace + "ACCURACY: 		"+str(0.001)+"\n\n"
-            else:
-                for w in q['answers']:
-                    TEXT+=codespace + "ANSWER:  "+str(w[1])+"  +++  "+str(w[0])+"\n\n"
-                    if w[0]==0.0:
-                        TEXT+=codespace + "ACCURACY: 		"+str(0.001)+"\n\n"
-        if q['type']=='matching':
-            TEXT+=codespace + "SHUFFLE: 		" + str(q['shuffle'])+"\n\n"
-            for w in q['QA']:
-                TEXT+=codespace + "Q&A:  "+w[0]+" +++ "+w[1]+"\n\n"
-        if q['type']=='multichoice':
-            TEXT+=codespace + "SHUFFLE: 		" + str(q['shuffle'])+"\n\n"
-            TEXT+=codespace + "SINGLE_ANSWER_Q: 		" + str(q['single_answer'])+"\n\n"
-            if len(q['answers'])==1:
-                TEXT+=codespace + "ANSWER:		"+q['answers'][0]+"\n\n"
+                    h=hash_bytes(data)
+                    self.db.execute("INSERT OR IGNORE INTO images VALUES (?,?)",(h,data))
+                    self.db.execute("INSERT INTO question_images VALUES (?,?,?)",(qid,link,h))
+                n+=1
+            for category,lines in shared.items():
+                self.db.execute("INSERT OR REPLACE INTO categories VALUES (?,?,?,?)",(source,category,category_blocks.get(category),json.dumps(lines)))
+            self.db.execute("DELETE FROM images WHERE NOT hash IN (SELECT hash FROM question_images)")
+        return n
+
+    def add_file(self,filename,md=True,errors=None,jobs=None):
+        """
+        Stores the questions of a Markdown (with the files it includes), XML
+        or .mbz file, unless it is stored already and neither it nor the
+        images of a Markdown file changed.
+        Returns the number of questions stored.
+        """
+        source=os.path.abspath(filename)
+        with open(filename,"rb") as f:
+            data=f.read()
+        old=self.db.execute("SELECT hash FROM sources WHERE path=?",(source,)).fetchone()
+        n=0
+        if filename[-3:] in ["mbz","xml"]:
+            h=hash_bytes(data)
+            if (old is not None) and (old[0]==h):
+                return 0
+            files={}
+            quiz=mbz_to_quiz(filename) if filename[-3:]=="mbz" else xmltodict.parse(data)['quiz']
+            text=xml_to_text(quiz,MARKDOWNIFY=md,images=ImageStore(files=files),errors=errors,jobs=jobs)
+            n+=self.add_text(text,source,files=files)
+        else:
+            text=data.decode('utf-8')
+            h=hash_bytes(json.dumps([text,directory_image_stamps(text,os.path.dirname(filename))]).encode('utf-8'))
+            for p in included_files(text):
+                n+=self.add_file(os.path.join(os.path.dirname(filename),p),md=md,errors=errors,jobs=jobs)
+            if (old is not None) and (old[0]==h):
+                return n
+            n+=self.add_text(text,source,base_dir=os.path.dirname(filename))
+        with self.db:
+            self.db.execute("UPDATE sources SET hash=? WHERE path=?",(h,source))
+        return n
+
+    def search(self,query=None,categories=None,names=None,limit=None):
+        """
+        Returns the questions matching the FTS5 query (all questions if
+        query is empty) whose category and name match the glob patterns,
+        best matches first, as dicts with their id, source, category, name,
+        type and block.
+        """
+        found=[]
+        try:
+            if (query):
+                rows=self.db.execute("SELECT q.id,q.source,q.category,q.name,q.type,q.block FROM question_text JOIN questions q ON q.id=question_text.rowid WHERE question_text MATCH ? ORDER BY rank",(query,))
             else:
-                for w in q['answers']:
-                    TEXT+=codespace + "ANSWER:		"+str(w[1])+" +++ "+w[0]+"\n\n"
-        if q['type']=='truefalse':
-            if len(q['answers'])==1:
-                TEXT+=codespace + "ANSWER:		"+q['answers'][0]+"\n\n"
+                rows=self.db.execute("SELECT id,source,category,name,type,block FROM questions ORDER BY id")
+            for row in rows:
+                if matches_any(row[2],categories) and matches_any(row[3],names):
+                    found.append(dict(zip(['id','source','category','name','type','block'],row)))
+                    if (limit) and (len(found)>=limit):
+                        break
+        except sqlite3.OperationalError as e:
+            raise Exception("Invalid search query "+repr(query)+" ("+str(e)+"). Queries use the FTS5 syntax: put terms with punctuation in double quotes, e.g. '\"x-ray\"'.")
+        return found
+
+    def export_text(self,questions,images=None):
+        """
+        Assembles the questions (as returned by search) into a Markdown bank,
+        grouped under the category blocks of their sources, and returns it.
+        Their images are added to images (an ImageStore); images of different
+        banks sharing a name are renamed.
+        """
+        if images is None:
+            images=ImageStore(files={})
+        groups={}
+        for q in questions:
+            groups.setdefault((q['source'],q['category']),[]).append(q)
+        header=""
+        if len(questions)>0:
+            header=self.db.execute("SELECT header FROM sources WHERE path=?",(questions[0]['source'],)).fetchone()[0]
+        blocks=[]
+        for (source,category),qs in groups.items():
+            cat=self.db.execute("SELECT block,shared_vars FROM categories WHERE source=? AND name=?",(source,category)).fetchone()
+            shared=[]
+            if cat is not None:
+                shared=json.loads(cat[1] or "[]")
+                if cat[0] is not None:
+                    blocks.append(shared_vars_line_re.sub("",cat[0]) if shared else cat[0])
+            for j,q in enumerate(qs):
+                block=q['block']
+                if len(shared)>0:
+                    # All SHARED_VARS of the category go to the first question,
+                    # as the questions declaring them may not be exported.
+                    block=shared_vars_line_re.sub("",block)
+                if (len(shared)>0) and (j==0):
+                    i=block.find("TEXT:")
+                    if i<0:
+                        i=len(block)
+                    block=block[:i]+"".join(["SHARED_VARS:\t\t"+v+"\n\n       " for v in shared])+block[i:]
+                for link,data in self.db.execute("SELECT qi.name,i.data FROM question_images qi JOIN images i ON i.hash=qi.hash WHERE qi.question=?",(q['id'],)):
+                    name=images.add(link,data)
+                    if name!=safe_image_filename(link):
+                        block=block.replace("![]("+link+")","![]("+name+")")
+                blocks.append(block)
+        return QUESTION_END.join([header]+blocks)
+
+    def export(self,questions,filename):
+        """
+        Writes the questions to filename: Moodle XML if it ends in .xml,
+        Markdown (with the images next to it) otherwise.
+        """
+        if filename[-3:]=="xml":
+            files={}
+            text=self.export_text(questions,ImageStore(files=files))
+            xml=text_to_xml_string(text,files=files,sort_questions=False)
+            with open(filename,"w") as f:
+                f.write(xml)
+        else:
+            text=self.export_text(questions,ImageStore(directory=os.path.dirname(os.path.abspath(filename))))
+            with open(filename,"w") as f:
+                f.write(text)
+
+def STOREBANK(filenameIn,filenameDB,md=True,keep_going=False,jobs=None):
+    store=QuestionStore(filenameDB)
+    errors=[] if keep_going else None
+    n=store.add_file(filenameIn,md=md,errors=errors,jobs=jobs)
+    total=store.db.execute("SELECT COUNT(*) FROM questions").fetchone()[0]
+    store.close()
+    for e in (errors or []):
+        print("WARNING! ########################################################## Skipped question ["+str(e['category'])+" / "+str(e['name'])+"]: "+e['exception'])
+    print("Stored "+str(n)+" questions from "+filenameIn+" in "+filenameDB+" ("+str(total)+" questions in total).")
+
+def QUERYSTORE(filenameDB,query=None,categories=None,names=None,filenameOut=None,overwrite=False):
+    if (filenameOut is not None) and (not(overwrite)) and (os.path.isfile(filenameOut)):
+        print("File already exists. Exiting")
+        return []
+    store=QuestionStore(filenameDB)
+    try:
+        questions=store.search(query,categories=categories,names=names)
+    except Exception as e:
+        store.close()
+        print(str(e))
+        return None
+    if filenameOut is None:
+        for q in questions:
+            print(q['source']+": ["+q['category']+" / "+str(q['name'])+"] ("+str(q['type'])+")")
+        print(str(len(questions))+" questions found.")
+    else:
+        store.export(questions,filenameOut)
+        print("Wrote "+str(len(questions))+" questions to "+filenameOut)
+    store.close()
+    return questions
+
+
+# # Comparing XML files
+
+# In[ ]:
+
+
+def iter_xml_questions(filename):
+    for event,el in ET.iterparse(filename,events=("end",)):
+        if el.tag=='question':
+            yield el
+            el.clear()
+
+def xml_element_fields(el):
+    q_type=el.get('type')
+    if q_type=='category':
+        return (q_type,html.unescape(el.findtext('category/text') or "").split("$/")[-1].strip())
+    return (q_type,html.unescape(el.findtext('name/text') or "").strip())
+
+def canonical_element(el,tail=False):
+    """
+    Returns a hashable form of el that does not depend on attribute order,
+    whitespace, CDATA vs escaped text or the order of dataset items,
+    dataset definitions and files. The text following every child (its
+    tail) is part of its parent's content; that of el only if tail.
+    """
+    text=el.text or ""
+    if el.tag=='file':
+        text="".join(text.split())
+    else:
+        text=canonical_value(" ".join(text.split()))
+    children=[canonical_element(c,True) for c in el]
+    if el.tag in ['dataset_items','dataset_definitions']:
+        children.sort(key=lambda c: (c[0],sorted_child_text(c,'number'),sorted_child_text(c,'name')))
+    elif any(c[0]=='file' for c in children):
+        files=sorted([c for c in children if c[0]=='file'],key=lambda c: dict(c[1]).get('name',''))
+        children=[c for c in children if c[0]!='file']+files
+    tail_text=canonical_value(" ".join((el.tail or "").split())) if tail else ""
+    return (el.tag,tuple(sorted((k,canonical_value(v)) for k,v in el.attrib.items())),text,tuple(children),tail_text)
+
+def canonical_value(v):
+    try:
+        return repr(float(v))
+    except ValueError:
+        return v
+
+def sorted_child_text(c,tag):
+    for child in c[3]:
+        if child[0]==tag:
+            text=child[2] or "".join(g[2] for g in child[3] if g[0]=='text')
+            try:
+                return (0,float(text),text)
+            except ValueError:
+                return (1,0.,text)
+    return (1,0.,"")
+
+def flatten_canonical(c,path="",out=None):
+    if out is None:
+        out={}
+    for k,v in c[1]:
+        out[path+"@"+k]=v
+    if c[2]:
+        out[path]=c[2]
+    if c[4]:
+        out[path+"#tail"]=c[4]
+    count={}
+    for child in c[3]:
+        count[child[0]]=count.get(child[0],0)+1
+        flatten_canonical(child,path+"/"+child[0]+"["+str(count[child[0]])+"]",out)
+    return out
+
+def hash_xml_questions(filename):
+    fields=[]
+    hashes=[]
+    for el in iter_xml_questions(filename):
+        fields.append(xml_element_fields(el))
+        hashes.append(hash_bytes(repr(canonical_element(el)).encode('utf-8')))
+    return dict(zip(question_keys(fields),hashes))
+
+def canonical_xml_questions(filename,keys):
+    current=[None]
+    def fields():
+        for el in iter_xml_questions(filename):
+            current[0]=el
+            yield xml_element_fields(el)
+    res={}
+    for key in question_keys(fields()): # el is still intact while its key is handled
+        if key in keys:
+            res[key]=canonical_element(current[0])
+    return res
+
+def compare_xml(filenameA,filenameB):
+    """
+    Compares two Moodle XML files question by question. Returns a dict with
+    the added, removed and changed question keys (category,name,n); for the
+    changed ones a list of (field, value in A, value in B).
+    """
+    A=hash_xml_questions(filenameA)
+    B=hash_xml_questions(filenameB)
+    changed=[key for key in A if (key in B) and (A[key]!=B[key])]
+    res={'added':[key for key in B if not(key in A)],
+         'removed':[key for key in A if not(key in B)],
+         'changed':[],
+         'unchanged':len(A)-len(changed)-len([key for key in A if not(key in B)])}
+    if len(changed)>0:
+        CA=canonical_xml_questions(filenameA,set(changed))
+        CB=canonical_xml_questions(filenameB,set(changed))
+        for key in changed:
+            fa=flatten_canonical(CA[key])
+            fb=flatten_canonical(CB[key])
+            fields=[(f,fa.get(f),fb.get(f)) for f in list(fa)+[f for f in fb if not(f in fa)] if fa.get(f)!=fb.get(f)]
+            res['changed'].append((key,fields))
+    return res
+
+def print_comparison(res,width=80,max_fields=10):
+    def short(v):
+        if v is None:
+            return "(none)"
+        return v if len(v)<=width else v[:width-3]+"..."
+    def label(key):
+        if key[1] is None:
+            return "[category]"
+        return key[1]+("" if key[2]==0 else " ("+str(key[2]+1)+")")
+    by_category={}
+    for what in ['removed','added']:
+        for key in res[what]:
+            by_category.setdefault(key[0],[]).append((what,key,[]))
+    for key,fields in res['changed']:
+        by_category.setdefault(key[0],[]).append(('changed',key,fields))
+    for cat in sorted(by_category):
+        print("# "+cat)
+        for what,key,fields in by_category[cat]:
+            print("   "+{'removed':'-','added':'+','changed':'~'}[what]+" "+label(key))
+            for f,a,b in fields[:max_fields]:
+                print("       "+f+": "+short(a)+" -> "+short(b))
+            if len(fields)>max_fields:
+                print("       ... and "+str(len(fields)-max_fields)+" more fields")
+    print(str(len(res['added']))+" added, "+str(len(res['removed']))+" removed, "
+          +str(len(res['changed']))+" changed, "+str(res['unchanged'])+" unchanged.")
+
+
+# # Moodle course backups (.mbz)
+
+# In[ ]:
+
+
+import tarfile
+import zipfile
+
+MBZ_QTYPES={'match':'matching','multianswer':'cloze'}
+MBZ_CONTEXTS={'10':'$system$','40':'$cat$','50':'$course$','70':'$module$'}
+MBZ_FILEAREAS=[('question','questiontext'),('qtype_ddimageortext','bgimage'),
+               ('qtype_ddimageortext','dragimage'),('qtype_ddmarker','bgimage')]
+
+def read_mbz_members(filename,names):
+    """
+    Reads the members names (a set of paths inside the archive) of a Moodle
+    backup into a dict, without extracting anything to disk. tar.gz backups
+    are streamed once and reading stops when every member has been found;
+    old zip backups are read directly.
+    """
+    names=set(names)
+    res={}
+    if len(names)==0:
+        return res
+    if zipfile.is_zipfile(filename):
+        with zipfile.ZipFile(filename) as z:
+            for name in z.namelist():
+                if name in names:
+                    res[name]=z.read(name)
+        return res
+    with tarfile.open(filename,"r|*") as tar:
+        for m in tar:
+            name=m.name[2:] if m.name.startswith("./") else m.name
+            if (m.isfile()) and (name in names):
+                res[name]=tar.extractfile(m).read()
+                names.discard(name)
+                if len(names)==0:
+                    break
+    return res
+
+def as_list(x):
+    if x is None:
+        return []
+    if type(x)==list:
+        return x
+    return [x]
+
+def mbz_text(x):
+    if (x is None) or (x=="$@NULL@$"):
+        return ""
+    return x
+
+def mbz_fraction(f):
+    return ("%.7f" % (100*float(f))).rstrip('0').rstrip('.')
+
+def mbz_category_paths(categories):
+    """
+    Returns the Moodle XML category path ($course$/top/...) of every
+    question category of a backup, by id.
+    """
+    byid=dict((c['@id'],c) for c in categories)
+    paths={}
+    for c in categories:
+        names=[]
+        p=c
+        while p is not None:
+            names.append(mbz_text(p['name']))
+            p=byid.get(mbz_text(p.get('parent')))
+        paths[c['@id']]=MBZ_CONTEXTS.get(mbz_text(c.get('contextlevel')),'$course$')+"/"+"/".join(reversed(names))
+    return paths
+
+def mbz_category_questions(c):
+    """
+    The questions of a backup category: directly listed (Moodle 3) or the
+    latest version of every question bank entry (Moodle 4).
+    """
+    qs=as_list((c.get('questions') or {}).get('question'))
+    for entry in as_list((c.get('question_bank_entries') or {}).get('question_bank_entry')):
+        latest=None
+        for version in as_list((entry.get('question_version') or {}).get('question_versions')):
+            for q in as_list((version.get('questions') or {}).get('question')):
+                if (latest is None) or (int(version.get('version') or 0)>=latest[0]):
+                    latest=(int(version.get('version') or 0),q)
+        if latest is not None:
+            qs.append(latest[1])
+    return qs
+
+def mbz_file(blobs,files,component,filearea,itemid):
+    res=[]
+    for name,contenthash in files.get((component,filearea,itemid),[]):
+        data=blobs.get(contenthash)
+        if data is None:
+            print("WARNING! ########################################################## File missing from backup: "+name)
+            continue
+        res.append({'@name':name,'#text':base64.b64encode(data).decode('ASCII')})
+    return res
+
+def mbz_answers(plugin,extra={}):
+    answers=[]
+    for a in as_list((plugin.get('answers') or {}).get('answer')):
+        ans={'@fraction':mbz_fraction(a['fraction']),'text':mbz_text(a['answertext'])}
+        ans.update(extra.get(a['@id'],{}))
+        answers.append(ans)
+    return answers
+
+def mbz_question_to_dict(q,qtype,blobs,files,subquestions):
+    """
+    Maps a question of a backup's questions.xml to the dict xmltodict would
+    give for the same question in a Moodle XML export, so xml_question_to_dict
+    can convert it.
+    """
+    plugin=q.get('plugin_qtype_'+qtype+'_question') or {}
+    d={'@type':MBZ_QTYPES.get(qtype,qtype),'name':{'text':mbz_text(q['name'])},
+       'questiontext':{'@format':'html','text':mbz_text(q['questiontext'])}}
+    img=mbz_file(blobs,files,'question','questiontext',q['@id'])
+    if len(img)>0:
+        d['questiontext']['file']=img
+    options=plugin.get(qtype) or plugin.get('matchoptions') or {}
+    if type(options)==dict:
+        for key in ['shuffleanswers','single','usecase','choose','subcats']:
+            if key in options:
+                d[key]=mbz_text(options[key])
+        if mbz_text(options.get('showmisplaced')) not in ["","0"]:
+            d['showmisplaced']=None
+    if qtype in ['multichoice','shortanswer']:
+        d['answer']=mbz_answers(plugin)
+    elif qtype=='truefalse':
+        tf=plugin.get('truefalse') or {}
+        names={mbz_text(tf.get('trueanswer')):'true',mbz_text(tf.get('falseanswer')):'false'}
+        d['answer']=mbz_answers(plugin,dict((i,{'text':t}) for i,t in names.items()))
+    elif qtype=='numerical':
+        tol=dict((r['answer'],{'tolerance':r['tolerance']}) for r in as_list((plugin.get('numerical_records') or {}).get('numerical_record')))
+        d['answer']=mbz_answers(plugin,tol)
+    elif qtype in ['calculated','calculatedsimple','calculatedmulti']:
+        recs=dict((r['answer'],{'tolerance':r['tolerance'],'correctanswerlength':r['correctanswerlength']})
+                  for r in as_list((plugin.get('calculated_records') or {}).get('calculated_record')))
+        d['answer']=mbz_answers(plugin,recs)
+        opts=as_list((plugin.get('calculated_options') or {}).get('calculated_option'))
+        if len(opts)>0:
+            d['single']=mbz_text(opts[0].get('single'))
+            d['shuffleanswers']=mbz_text(opts[0].get('shuffleanswers'))
+        defs=[]
+        for v in as_list((plugin.get('dataset_definitions') or {}).get('dataset_definition')):
+            o=mbz_text(v['options']).split(':')
+            items=[{'number':i['number'],'value':i['value']} for i in as_list((v.get('dataset_items') or {}).get('dataset_item'))]
+            defs.append({'status':{'text':'private' if mbz_text(v.get('category')) in ["","0"] else 'shared'},
+                         'name':{'text':v['name']},'type':'calculated','distribution':{'text':o[0]},
+                         'minimum':{'text':o[1]},'maximum':{'text':o[2]},'decimals':{'text':o[3] if len(o)>3 else "0"},
+                         'itemcount':v['itemcount'],'dataset_items':{'dataset_item':items}})
+        d['dataset_definitions']={'dataset_definition':defs}
+    elif qtype=='match':
+        d['subquestion']=[{'text':mbz_text(m['questiontext']),'answer':{'text':mbz_text(m['answertext'])}}
+                          for m in as_list((plugin.get('matches') or {}).get('match'))]
+    elif qtype=='gapselect':
+        d['selectoption']=[{'text':mbz_text(a['answertext']),'group':mbz_text(a['feedback'])}
+                           for a in as_list((plugin.get('answers') or {}).get('answer'))]
+    elif qtype=='ddwtos':
+        d['dragbox']=[]
+        for a in as_list((plugin.get('answers') or {}).get('answer')):
+            fb=mbz_text(a['feedback'])
+            group=re.search(r'"draggroup";(?:s:\d+:"|i:)(\d+)',fb)
+            box={'text':mbz_text(a['answertext']),'group':group.group(1) if group else "1"}
+            if re.search(r'"infinite";(?:s:\d+:"|i:|b:)1',fb):
+                box['infinite']=None
+            d['dragbox'].append(box)
+    elif qtype in ['ddimageortext','ddmarker']:
+        bg=mbz_file(blobs,files,'qtype_'+qtype,'bgimage',q['@id'])
+        if len(bg)>0:
+            d['file']=bg[0]
+        d['drag']=[]
+        for g in as_list((plugin.get('drags') or {}).get('drag')):
+            drag={'no':g['no'],'text':mbz_text(g.get('label')),'draggroup':mbz_text(g.get('draggroup')),
+                  'noofdrags':mbz_text(g.get('noofdrags')) or "1"}
+            if mbz_text(g.get('infinite')) not in ["","0"]:
+                drag['infinite']=None
+            im=mbz_file(blobs,files,'qtype_ddimageortext','dragimage',g['@id']) if qtype=='ddimageortext' else []
+            if len(im)>0:
+                drag['file']=im[0]
+            d['drag'].append(drag)
+        d['drop']=[dict((k,mbz_text(p.get(k))) for k in ['no','xleft','ytop','choice','shape','coords'])
+                   for p in as_list((plugin.get('drops') or {}).get('drop'))]
+    elif qtype=='multianswer':
+        seq=mbz_text((plugin.get('multianswer') or {}).get('sequence')).split(',')
+        text=d['questiontext']['text']
+        for i,sid in enumerate(seq):
+            if sid in subquestions:
+                text=text.replace("{#"+str(i+1)+"}",mbz_text(subquestions[sid]['questiontext']))
+        d['questiontext']['text']=text
+    return d
+
+def mbz_to_quiz(filename):
+    """
+    Reads the question bank of a Moodle course backup into the same dict
+    xmltodict makes of a Moodle XML export ({'question':[...]}).
+    """
+    data=read_mbz_members(filename,["questions.xml","files.xml"])
+    if not("questions.xml" in data):
+        raise Exception('No questions.xml in '+filename)
+    categories=as_list(xmltodict.parse(data["questions.xml"])['question_categories'].get('question_category'))
+    files={}
+    needed=set()
+    if "files.xml" in data:
+        for f in as_list(xmltodict.parse(data["files.xml"])['files'].get('file')):
+            key=(f['component'],f['filearea'],f['itemid'])
+            if (key[:2] in MBZ_FILEAREAS) and (f['filename']!="."):
+                files.setdefault(key,[]).append((f['filename'],f['contenthash']))
+                needed.add(f['contenthash'])
+    members=read_mbz_members(filename,["files/"+h[:2]+"/"+h for h in needed])
+    blobs=dict((name.split("/")[-1],b) for name,b in members.items())
+
+    paths=mbz_category_paths(categories)
+    questions=[(c,mbz_category_questions(c)) for c in categories]
+    subquestions=dict((q['@id'],q) for c,qs in questions for q in qs if mbz_text(q.get('parent')) not in ["","0"])
+    quiz=[]
+    for c,qs in questions:
+        if len(qs)==0:
+            continue
+        quiz.append({'@type':'category','category':{'text':paths[c['@id']]}})
+        for q in qs:
+            qtype=mbz_text(q.get('qtype'))
+            if q['@id'] in subquestions:
+                continue
+            if not(MBZ_QTYPES.get(qtype,qtype) in QUESTION_TYPES):
+                print("WARNING! ########################################################## Skipping "+qtype+" question: "+mbz_text(q.get('name')))
+                continue
+            quiz.append(mbz_question_to_dict(q,qtype,blobs,files,subquestions))
+    return {'question':quiz}
+
+
+# # Checking question text files
+
+# In[ ]:
+
+
+QUESTION_TYPES=['category','description','ddimageortext','ddmarker','shortanswer','essay','randomsamatch',
+                'matching','calculated_simple','calculated','calculatedsimple','calculatedmulti','multichoice',
+                'truefalse','missing_words','gapselect','ddwtos','numerical','cloze']
+INFINITE_WORDS=['YES','Yes','yes','y','Y','inf','Inf','INF','INFINITY','Infinity','infinity']
+DDMARKER_SHAPES=['circle','rectangle','polygon']
+image_link_re=re.compile(r"!\[\]\(([^)]*)\)")
+
+def line_of(block,needle,start=0):
+    i=block.find(needle,start)
+    if i<0:
+        return 0
+    return block.count("\n",0,i)
+
+def field_lines(block,key):
+    """
+    Like extract_line, but returns (line within block, value) pairs.
+    """
+    res=[]
+    i=block.find(key)
+    while i>=0:
+        res.append((block.count("\n",0,i),block[i+len(key):].split("\n")[0].strip()))
+        i=block.find(key,i+len(key))
+    return res
+
+def check_weights(block,key,problems,single=True,all_or_nothing=False):
+    weights=[]
+    for l,value in field_lines(block,key):
+        parts=value.split("+++")
+        if len(parts)<2:
+            problems.append((l,key+" line has no 'weight +++ answer' form: "+value))
+            continue
+        try:
+            w=float(parts[0])
+        except ValueError:
+            problems.append((l,"Answer weight is not a number: "+parts[0].strip()))
+            continue
+        if (w<-100) or (w>100):
+            problems.append((l,"Answer weight outside [-100,100]: "+parts[0].strip()))
+        if parts[1].strip()=="":
+            problems.append((l,"Empty answer"))
+        weights.append(w)
+    if len(weights)==0:
+        return weights
+    if (single) and not(all_or_nothing) and (max(weights)!=100):
+        problems.append((line_of(block,key),"No answer has weight 100"))
+    if (not(single)) and (abs(sum([w for w in weights if w>0])-100)>0.5):
+        problems.append((line_of(block,key),"Positive answer weights add up to "+str(round(sum([w for w in weights if w>0]),4))+" instead of 100"))
+    if (all_or_nothing) and (len([w for w in weights if w==100])!=1):
+        problems.append((line_of(block,key),"Exactly one answer should have weight 100"))
+    return weights
+
+def declared_vars(block,key):
+    names=[]
+    for l,line in field_lines(strip_latex(block),key):
+        for v in line.split(";"):
+            if v.strip()=="":
+                continue
+            v=v.split("=")
+            if len(v)!=2:
+                names.append((None,l,"=".join(v)))
             else:
-                for w in q['answers']:
-                    TEXT+=codespace + "ANSWER:		"+str(w[1])+" +++ "+w[0]+"\n\n"
-        if q['type']=='shortanswer':
-            TEXT+=codespace + "CASE: 		" + q['case']+"\n\n"
-            #if len(q['answers'])==1:
-            #    TEXT+="ANSWER:		"+q['answers'][0]+"\n"
-            #else:
-            for w in q['answers']:
-                TEXT+=codespace + "ANSWER:		"+str(w[1])+" +++ "+w[0]+"\n\n"
-        if q['type']=='randomsamatch':
-            if q['subcats'] in ['1','True','TRUE','true']:
-                TEXT+=codespace + "SUBCATS:		True\n\n"
+                names.append((v[0].strip(),l,v[1].strip()))
+    return names
+
+def check_dragdrop(block,q_type,problems):
+    if not("DRAG_DROP:" in block):
+        problems.append((0,"Missing DRAG_DROP: table"))
+        return
+    start=line_of(block,"DRAG_DROP:")
+    rows=block.split("DRAG_DROP:")[1].split(r"%%%")[0].split("\n")
+    background=False
+    drags=0
+    uses=None
+    limit=1
+    drops=0
+    for n,dd in enumerate(rows):
+        dd=dd.strip()
+        l=start+n
+        if dd[:4]=='![](':
+            background=True
+        if (len(dd)<=4) or (dd[0]!='|') or (dd[1]==":") or (dd[1:].strip()[:4]=="Drop"):
+            continue
+        a=dd.split('|')[1:]
+        if len(a)<4:
+            problems.append((l,"Drag and drop row has "+str(len(a))+" columns instead of at least 4: "+dd))
+            continue
+        if a[2].strip()!='':
+            drags+=1
+            uses=0
+            infinite=a[3].strip() in INFINITE_WORDS
+            limit=1
+            if (q_type=='ddmarker') and not(infinite):
+                try:
+                    limit=int(a[3].strip())
+                except ValueError:
+                    if a[3].strip()!='':
+                        problems.append((l,"Number of uses is neither a number nor infinite: "+a[3].strip()))
+            if q_type=='ddimageortext':
+                try:
+                    int(a[1].strip())
+                except ValueError:
+                    problems.append((l,"Drag group is not a number: "+a[1].strip()))
+        if a[0].strip()!='':
+            if uses is None:
+                problems.append((l,"Drop zone before the first drag item"))
+                continue
+            uses+=1
+            drops+=1
+            if not(infinite) and (uses>limit):
+                problems.append((l,"Using a drag item more times than set in table"))
+            if q_type=='ddimageortext':
+                xy=a[0].split(',')
+                try:
+                    if len(xy)!=2:
+                        raise ValueError
+                    int(xy[0]); int(xy[1])
+                except ValueError:
+                    problems.append((l,"Drop zone is not 'x, y' in pixels: "+a[0].strip()))
             else:
-                TEXT+=codespace + "SUBCATS:		False\n\n"
-            TEXT+=codespace + "CHOOSE:		"+q['choose']+"\n\n"
-                
-        if (MARKDOWNIFY):
-            TEXT += codespace + "MARKDOWN\n\n"
-        #tt=re.sub("\n\n+","\n\n",tt).strip()
-        #tt=tt.replace(r"&nbsp;"," ")
-        #tt=tt.replace(r"&#160;"," ")
-        #tt=tt.replace(r"&#8217;","'")
-        #tt=urllib.parse.unquote(tt, encoding='utf-8', errors='replace')
-        TEXT += codespace + "TEXT:\n\n"+q['text']+"\n"
-        
-        if q['type']in ['ddimageortext','ddmarker']:
-            #TEXT+=codespace + "SHUFFLE: 		" + str(q['shuffle'])+"\n\n"
-            #TEXT+=codespace + "SHOWMISPLACED: 		" + str(q['showmisplaced'])+"\n\n"
-            TEXT+="\n"+codespace + "DRAG_DROP:\n\n"+q['drag-drop']+"\n\n"
-        
-        TEXT = "\n".join([s.rstrip() for s in TEXT.split("\n")])
-        TEXT=TEXT.replace("\n.\n","\n\n")
-        TEXT=re.sub("\n\n+","\n\n",TEXT).rstrip()
-        #print(Qs)
-    #import html
-    
-    TEXT=html.unescape(TEXT)
-    #print(TEXT)
-    return TEXT
+                if a[0].strip() not in DDMARKER_SHAPES:
+                    problems.append((l,"Unknown drop zone shape: "+a[0].strip()))
+                for xy in a[1].split(';'):
+                    try:
+                        [int(c) for c in xy.replace(',',' ').split()]
+                    except ValueError:
+                        problems.append((l,"Drop zone coordinates are not integers: "+a[1].strip()))
+                        break
+    if not(background):
+        problems.append((start,"No background image in DRAG_DROP:"))
+    if drags==0:
+        problems.append((start,"No drag items in DRAG_DROP: table"))
+    if drops==0:
+        problems.append((start,"No drop zones in DRAG_DROP: table"))
+
+def check_missing_words(block,text,q_type,problems):
+    missing_words=extract_arg_of_function(text,"",brackets=["[[","]]"])
+    if len(missing_words)==0:
+        problems.append((line_of(block,"TEXT:"),"No [[group@answer]] gaps in text"))
+    correct=[]
+    for w in missing_words:
+        if not("@" in w):
+            problems.append((line_of(block,"[["+w+"]]"),"Gap is not of the form [[group@answer]]: "+w))
+            continue
+        group=w.split("@")[0]
+        if not(group.split('U')[0].strip().isdigit()):
+            problems.append((line_of(block,"[["+w+"]]"),"Gap group is not a number: "+group))
+        if (q_type=='ddwtos') and (len(group.split('U'))==1) and (missing_words.count(w)>1):
+            problems.append((line_of(block,"[["+w+"]]"),"Word used more than once but set to single use (write U after the group number): "+w))
+        correct.append([group.split('U')[0].strip(),"@".join(w.split("@")[1:]).strip()])
+    if q_type=='ddwtos':
+        uses={}
+        for w in missing_words:
+            if "@" in w:
+                key="@".join(w.split("@")[1:]).strip()
+                uses.setdefault((w.split("@")[0].split('U')[0].strip(),key),set()).add(len(w.split("@")[0].split('U'))==2)
+        for key,u in uses.items():
+            if len(u)>1:
+                problems.append((line_of(block,key[1]),"Answer not consistently set to unlimited/limited use: "+key[1]))
+    for l,value in field_lines(block,"CAT&WRONG_ANS:"):
+        parts=value.split("+++")
+        if len(parts)<2:
+            problems.append((l,"CAT&WRONG_ANS: line has no 'group +++ answer' form: "+value))
+            continue
+        if not(parts[0].split('U')[0].strip().isdigit()):
+            problems.append((l,"Wrong answer group is not a number: "+parts[0].strip()))
+        if [parts[0].split('U')[0].strip(),parts[1].strip()] in correct:
+            problems.append((l,"Wrong answer identical to a correct answer: "+parts[1].strip()))
+
+def check_cloze(block,text,problems):
+    try:
+        for start,end,f,arg in cloze_calls(text):
+            try:
+                parse_cloze_call(f,arg)
+            except SyntaxError as e:
+                problems.append((line_of(block,f+"("+arg),"Cannot parse "+f+"(...): "+str(e.msg)))
+            except (ValueError,ArithmeticError) as e:
+                problems.append((line_of(block,f+"("+arg),"Cannot parse "+f+"(...): "+str(e)))
+    except Exception as e:
+        problems.append((line_of(block,"TEXT:"),str(e)))
+
+def check_images(block,problems,base_dir="."):
+    for m in image_link_re.finditer(block):
+        filename=m.group(1).replace("$","SsS").replace(r"?","QqQ")
+        if not(os.path.isfile(os.path.join(base_dir,filename))):
+            problems.append((block.count("\n",0,m.start()),"Image not found: "+m.group(1)))
+
+def check_question(block,shared_names=(),base_dir="."):
+    """
+    Checks one question block the way extract_question would read it, without
+    rendering markdown, encoding images or sampling variables. Returns a list
+    of (line within block, message) pairs.
+    """
+    problems=[]
+    if is_include_block(block):
+        for l,path in field_lines(block,"INCLUDE:"):
+            if not(os.path.isfile(os.path.join(base_dir,path))):
+                problems.append((l,"Included file not found: "+path))
+        return problems
+    try:
+        q_type=extract_line(block,"TYPE:")[0]
+    except IndexError:
+        return [(0,"Missing TYPE:")]
+    if not(q_type in QUESTION_TYPES):
+        return [(line_of(block,"TYPE:"),"Unknown question type: "+q_type)]
+    if len(extract_line(block,"NAME:"))==0:
+        problems.append((0,"Missing NAME:"))
+    if q_type=='category':
+        return problems
+    try:
+        text=block.split("TEXT:")[1].split("DRAG_DROP:")[0]
+    except IndexError:
+        text=""
+        problems.append((0,"Missing TEXT:"))
+    if q_type in ['shortanswer','multichoice','truefalse','numerical']:
+        if len(extract_line(block,"ANSWER:"))==0:
+            problems.append((0,"No ANSWER: lines"))
+    if q_type=='shortanswer':
+        check_weights(block,"ANSWER:",problems)
+    elif q_type=='multichoice':
+        try:
+            single=eval(extract_line(block,"SINGLE_ANSWER_Q:")[0])
+        except:
+            single=True
+        check_weights(block,"ANSWER:",problems,single=single)
+    elif q_type=='truefalse':
+        check_weights(block,"ANSWER:",problems,all_or_nothing=True)
+        if len(field_lines(block,"ANSWER:"))!=2:
+            problems.append((line_of(block,"ANSWER:"),"True/false question needs exactly 2 answers"))
+    elif q_type=='numerical':
+        answers=field_lines(block,"ANSWER:")
+        if len(answers)>1:
+            check_weights(block,"ANSWER:",problems)
+        for l,value in answers:
+            try:
+                float(value.split("+++")[-1])
+            except ValueError:
+                problems.append((l,"Numerical answer is not a number: "+value.split("+++")[-1].strip()))
+    elif q_type=='matching':
+        QA=field_lines(block,"Q&A:")
+        if len(QA)<2:
+            problems.append((0,"Matching question needs at least 2 Q&A: lines"))
+        for l,value in QA:
+            if len(value.split("+++"))<2:
+                problems.append((l,"Q&A: line has no 'question +++ answer' form: "+value))
+    elif q_type=='randomsamatch':
+        try:
+            int(extract_line(block,"CHOOSE:")[0])
+        except (IndexError,ValueError):
+            problems.append((line_of(block,"CHOOSE:"),"CHOOSE: should be an integer"))
+    elif q_type in ['ddimageortext','ddmarker']:
+        check_dragdrop(block,q_type,problems)
+    elif q_type in ['missing_words','gapselect','ddwtos']:
+        check_missing_words(block,text,'gapselect' if q_type=='missing_words' else q_type,problems)
+    elif q_type=='cloze':
+        check_cloze(block,text,problems)
+    elif q_type in ['calculated_simple','calculated','calculatedsimple','calculatedmulti']:
+        eq=field_lines(block,"EQUATION:")
+        if len(eq)==0:
+            problems.append((0,"No EQUATION: line"))
+        elif (len(eq)>1) or (q_type=='calculatedmulti'):
+            try:
+                single=eval(extract_line(block,"SINGLE_ANSWER_Q:")[0])
+            except:
+                single=True
+            if len(eq)>1:
+                check_weights(block,"EQUATION:",problems,single=single)
+        private=set()
+        for v,l,value in declared_vars(block,"PRIVATE_VARS:"):
+            if v is None:
+                problems.append((l,"Variable definition is not 'name=value': "+value))
+            elif v in private:
+                problems.append((l,"Variable defined twice: "+v))
+            private.add(v)
+        known=set(shared_names)|private
+        for v in set(find_used_vars(strip_latex(text))+find_used_vars(str([e[1] for e in eq]))):
+            if not(v in known):
+                problems.append((line_of(block,"{"+v+"}"),"Variable undefined: "+v))
+    check_images(block,problems,base_dir)
+    return problems
+
+def text_blocks(text):
+    """
+    Yields (line,category,block) for every block of text, with line the
+    1-based line number of the block's first line in text.
+    """
+    line=1
+    category=""
+    for n,piece in enumerate(split_text_pieces(text)):
+        if n==0:
+            line+=piece.count("\n")
+            continue
+        m=re.match(QUESTION_SPLIT,piece)
+        start=line+piece.count("\n",0,m.end())
+        line+=piece.count("\n")
+        block=piece[m.end():]
+        if re.search("TYPE:[ \t]*category",block):
+            try:
+                category=extract_line(block,"NAME:")[0].replace("$course$/","")
+            except IndexError:
+                category=""
+        yield start,category,block
+
+def _check_question(args):
+    return check_question(*args)
+
+def check_text(text,base_dir=".",jobs=None):
+    """
+    Lints a Markdown question bank in one pass and returns the problems as
+    (line,category,name,message) tuples, sorted by line. Questions are
+    checked in parallel over jobs processes.
+    """
+    blocks=list(text_blocks(text))
+    shared={}
+    for line,category,block in blocks:
+        shared.setdefault(category,[]).extend(declared_shared_vars(block))
+    tasks=[(block,shared[category],base_dir) for line,category,block in blocks]
+    if (jobs==1) or (len(tasks)<2):
+        results=map(_check_question,tasks)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as ex:
+            results=list(ex.map(_check_question,tasks,chunksize=max(1,len(tasks)//(4*(jobs or os.cpu_count() or 1)))))
+    problems=[]
+    for (line,category,block),res in zip(blocks,results):
+        try:
+            name=extract_line(block,"NAME:")[0]
+        except IndexError:
+            name=""
+        for l,msg in res:
+            problems.append((line+l,category,name,msg))
+    return sorted(problems)
+
+def CHECKTEXT(filenameIn,jobs=None):
+    with open(filenameIn) as f:
+        contents=f.read()
+    problems=check_text(contents,base_dir=os.path.dirname(os.path.abspath(filenameIn)),jobs=jobs)
+    for line,category,name,msg in problems:
+        print(filenameIn+":"+str(line)+": ["+category+" / "+name+"] "+msg)
+    print(str(len(problems))+" problems found in "+filenameIn+".")
+    return problems
+
+
+# # HTML preview
+
+# In[ ]:
+
+
+PREVIEW_HEAD="""<!DOCTYPE html>
+<html><head><meta charset="utf-8">
+<script>MathJax={tex:{inlineMath:[['$','$'],['\\\\(','\\\\)']]}};</script>
+<script async src="https://cdn.jsdelivr.net/npm/mathjax@3/es5/tex-mml-chtml.js"></script>
+<style>
+body{font-family:sans-serif;max-width:60em;margin:auto}
+.question{border:1px solid #ccc;margin:1em 0;padding:0 1em 1em 1em}
+.fields td{border:1px solid #ddd;padding:0.2em 0.5em}
+.fields td p{margin:0}
+</style>
+</head><body>
+"""
+image_size_re=re.compile(r"!\[\]\(([^)]*)\)(?:\{width=([^}]*)\})?")
+
+def preview_images(text,image_dir=""):
+    def img(m):
+        width=m.group(2)
+        if width is None:
+            style=""
+        else:
+            width=width.strip()
+            style=' style="width:'+(width+"px" if width.isdigit() else width)+'"'
+        return '<img src="'+html.escape(os.path.join(image_dir,m.group(1).strip()))+'"'+style+' />'
+    return image_size_re.sub(img,text)
+
+def dragdrop_choices(dragdrop,q_type,image_dir=""):
+    """
+    Reads the DRAG_DROP table of a Markdown question into the main image and
+    the choices used by ddimageortext_overlay and ddmarker_overlay.
+    """
+    main_image=""
+    choices=[]
+    for dd in dragdrop.split("\n"):
+        dd=dd.strip()
+        if dd[:4]=='![](' and main_image=="":
+            main_image=os.path.join(image_dir,dd[4:].split(")")[0])
+        if (len(dd)>4) and (dd[0]=='|') and (dd[1]!=":") and (dd[1:].strip()[:4]!="Drop"):
+            a=[c.strip() for c in dd.split('|')[1:]]
+            if a[2]!='':
+                if q_type=='ddmarker':
+                    choices.append({'text':a[2],'shape':[],'coords':[]})
+                elif "![](" in a[2]:
+                    choices.append({'text':'nOtHiNgHeRE','filename':os.path.join(image_dir,a[2].split('![](')[1].split(")")[0]),'location':[]})
+                else:
+                    choices.append({'text':a[2],'location':[]})
+            if (a[0]!='') and (len(choices)>0):
+                if q_type=='ddmarker':
+                    choices[-1]['shape'].append(a[0])
+                    choices[-1]['coords'].append(a[1])
+                else:
+                    choices[-1]['location'].append([c.strip() for c in a[0].split(',')])
+    return main_image,choices
+
+def preview_question(block,image_dir=""):
+    """
+    Renders one block of a Markdown question bank to HTML: the name, type and
+    fields (answers, variables, ...) of the question, its text and, for drag
+    and drop questions, the drop zones drawn over the background image.
+    """
+    if is_include_block(block):
+        return "".join(['<p class="include">INCLUDE: '+html.escape(path)+"</p>\n" for path in extract_line(block,"INCLUDE:")])
+    name=extract_line(block,"NAME:")[0]
+    q_type=extract_line(block,"TYPE:")[0]
+    head=block.split("TEXT:")[0]
+    try:
+        text=block.split("TEXT:")[1].split("DRAG_DROP:")[0]
+    except IndexError:
+        text=""
+    if "MARKDOWN" in head:
+        text=markdownToHTML(text)
+    text=preview_images(text.strip(),image_dir)
+    if q_type=='category':
+        return "<h2>"+html.escape(name.replace("$course$/",""))+"</h2>\n"+text+"\n"
+    rows=[]
+    for m in re.finditer(r"(?m)^[ \t]*([A-Z][A-Z_&]*):[ \t]*(.*)$",head):
+        if not(m.group(1) in ["NAME","TYPE"]):
+            rows.append("<tr><td>"+m.group(1)+"</td>"+"".join(["<td>"+markdownToHTML(c.strip())+"</td>" for c in m.group(2).split("+++")])+"</tr>")
+    out='<div class="question">\n<h3>'+html.escape(name)+" <small>("+html.escape(q_type)+")</small></h3>\n"
+    if rows:
+        out+='<table class="fields">\n'+"\n".join(rows)+"\n</table>\n"
+    out+=text+"\n"
+    if (q_type in ['ddimageortext','ddmarker']) and ("DRAG_DROP:" in block):
+        dragdrop=block.split("DRAG_DROP:")[1].split(r"%%%")[0]
+        main_image,choices=dragdrop_choices(dragdrop,q_type,image_dir)
+        if q_type=='ddmarker':
+            out+=ddmarker_overlay(main_image,choices)
+        else:
+            out+=ddimageortext_overlay(main_image,choices)
+    return out+"</div>\n"
+
+def _preview_question(args):
+    try:
+        return preview_question(*args)
+    except Exception as e:
+        return '<div class="question"><pre>'+html.escape(args[0])+"</pre><p>"+html.escape(type(e).__name__+": "+str(e))+"</p></div>\n"
+
+def preview_text(text,image_dir="",jobs=None,cache=None,prune=True):
+    """
+    Renders a Markdown question bank to a static HTML page. Questions are
+    rendered in parallel over jobs processes. cache maps the hash of a block
+    to its HTML; blocks found there are not rendered again, and on return it
+    holds exactly the blocks of text (all blocks seen, if not prune).
+    """
+    if cache is None:
+        cache={}
+    keys=[]
+    tasks={}
+    found={}
+    for line,category,block in text_blocks(text):
+        key=hash_bytes((image_dir+"\n"+block).encode('utf-8'))
+        keys.append(key)
+        found[key]=cache.get(key)
+        if found[key] is None:
+            tasks[key]=(block,image_dir)
+    if (jobs==1) or (len(tasks)<2):
+        results=map(_preview_question,tasks.values())
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=jobs) as ex:
+            results=list(ex.map(_preview_question,tasks.values(),chunksize=max(1,len(tasks)//(4*(jobs or os.cpu_count() or 1)))))
+    found.update(zip(tasks.keys(),results))
+    cache.update([(key,found[key]) for key in tasks])
+    if (prune):
+        for key in set(cache.keys())-set(keys):
+            cache.pop(key,None)
+    return PREVIEW_HEAD+"".join([found[key] for key in keys])+"</body></html>\n"
+
+def PREVIEWTEXT(filenameIn,filenameOut,jobs=None,overwrite=False):
+    # A page written by an earlier preview (it has a .preview.json next to
+    # it) is replaced; any other existing file only with overwrite.
+    if (not(overwrite)) and (os.path.isfile(filenameOut)) and not(os.path.isfile(filenameOut+".preview.json")):
+        print("File already exists. Exiting")
+        return
+    with open(filenameIn) as f:
+        contents=f.read()
+    try:
+        with open(filenameOut+".preview.json") as f:
+            cache=json.load(f)
+    except (OSError,ValueError):
+        cache={}
+    image_dir=os.path.relpath(os.path.dirname(os.path.abspath(filenameIn)),os.path.dirname(os.path.abspath(filenameOut)))
+    if image_dir==".":
+        image_dir=""
+    page=preview_text(contents,image_dir=image_dir,jobs=jobs,cache=cache)
+    with open(filenameOut,"w") as f:
+        f.write(page)
+    with open(filenameOut+".preview.json","w") as f:
+        json.dump(cache,f)
+    print("Wrote "+filenameOut)
+
+
+# # In-memory conversion API
+
+# In[ ]:
+
+
+class ImageFiles(object):
+    """
+    Image source for the in-memory API that reads from a directory and keeps
+    every file's bytes and base64 encoding until the file changes on disk.
+    """
+    def __init__(self,directory="."):
+        self.directory=directory
+        self.cache={}
+
+    def stamp(self,filename):
+        st=os.stat(os.path.join(self.directory,filename))
+        return (st.st_mtime_ns,st.st_size)
+
+    def _entry(self,filename):
+        stamp=self.stamp(filename)
+        e=self.cache.get(filename)
+        if (e is None) or (e[0]!=stamp):
+            with open(os.path.join(self.directory,filename),"rb") as f:
+                data=f.read()
+            e=(stamp,data,base64.b64encode(data))
+            self.cache[filename]=e
+        return e
+
+    def __call__(self,filename):
+        return self._entry(filename)[1]
+
+    def b64(self,filename):
+        return self._entry(filename)[2]
+
+def text_to_xml_string(text,files=None,seed=None,sort_questions=True,categories=None,names=None,errors=None,cache=None):
+    """
+    Converts Markdown text to Moodle XML and returns it as a string. Images
+    are read from files (a dict filename -> bytes, or a function taking a
+    filename) instead of the working directory, and variables are sampled
+    from their own random generator (seeded with seed). No global state is
+    used, so conversions can run concurrently in threads. cache is passed to
+    text_to_xml; it is not used with a seed, so that seeded conversions are
+    reproducible.
+    """
+    if seed is not None:
+        cache=None
+    def run():
+        image_files.set(files)
+        random_state.set(np.random.RandomState(seed))
+        t=sort_qs_in_text(text) if sort_questions else text
+        return text_to_xml(t,None,categories=categories,names=names,errors=errors,cache=cache)
+    return contextvars.copy_context().run(run)
+
+def xml_string_to_text(xml,md=True,sort_questions=True,files=None,errors=None):
+    """
+    Converts a Moodle XML string (or bytes) to Markdown. Returns the text and
+    the dict files (filename -> bytes) holding the images it refers to;
+    nothing is written to disk.
+    """
+    if files is None:
+        files={}
+    quiz=xmltodict.parse(xml)['quiz']
+    text=xml_to_text(quiz,MARKDOWNIFY=md,images=ImageStore(files=files),errors=errors)
+    if (sort_questions):
+        text=sort_qs_in_text(text)
+    return text,files
+
+
+# # Conversion server
+
+# In[ ]:
+
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    """
+    POST /md2xml, /xml2md, /check and /preview with a JSON body
+    (Content-Type: application/json, Host 127.0.0.1 or localhost); answers
+    with JSON. Markdown requests give "text" and optionally "base_dir" (where
+    images are looked up) and "seed"; /preview takes an optional "document"
+    id keying its cache; /xml2md gives "xml" and optionally "md".
+    """
+    def allowed(self):
+        # Only local clients posting JSON: a web page can neither reach the
+        # server through another host name (DNS rebinding) nor post a form.
+        port=str(self.server.server_address[1])
+        if not(self.headers.get('Host','') in ["127.0.0.1:"+port,"localhost:"+port]):
+            return 403,{'error':'Host not allowed: '+str(self.headers.get('Host'))}
+        if self.headers.get('Content-Type','').split(";")[0].strip().lower()!="application/json":
+            return 415,{'error':'Content-Type must be application/json'}
+        return None,None
+
+    def do_POST(self):
+        code,res=self.allowed()
+        if code is not None:
+            self.respond(code,res)
+            return
+        try:
+            req=json.loads(self.rfile.read(int(self.headers.get('Content-Length',0))) or b"{}")
+            res=self.server.handle_request_json(self.path.rstrip("/"),req)
+            code=200
+        except Exception as e:
+            res={'error':type(e).__name__+": "+str(e)}
+            code=400
+        self.respond(code,res)
+
+    def respond(self,code,res):
+        data=json.dumps(res).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self,format,*args):
+        None
+
+class LockedCache(object):
+    """
+    A dict shared by the request threads of the server. Every access holds
+    the lock; a lookup of a missing (or just cleared) key returns None.
+    """
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.data={}
+
+    def get(self,key,default=None):
+        with self.lock:
+            return self.data.get(key,default)
+
+    def __setitem__(self,key,value):
+        with self.lock:
+            self.data[key]=value
+
+    def setdefault(self,key,value):
+        with self.lock:
+            return self.data.setdefault(key,value)
+
+    def update(self,items):
+        with self.lock:
+            self.data.update(items)
+
+    def pop(self,key,default=None):
+        with self.lock:
+            return self.data.pop(key,default)
+
+    def keys(self):
+        with self.lock:
+            return list(self.data)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
+
+class ConversionServer(ThreadingHTTPServer):
+    """
+    Keeps the interpreter, the Markdown renderers, the image cache of every
+    base directory and the compiled questions warm between requests, which
+    are handled concurrently.
+    """
+    daemon_threads=True
+    max_cache=20000
+
+    def __init__(self,address=("127.0.0.1",8765)):
+        ThreadingHTTPServer.__init__(self,address,ConversionHandler)
+        self.images=LockedCache()
+        self.cache=LockedCache()
+        self.previews=LockedCache()
+
+    def image_files(self,base_dir):
+        base_dir=os.path.abspath(base_dir)
+        files=self.images.get(base_dir)
+        if files is None:
+            files=self.images.setdefault(base_dir,ImageFiles(base_dir))
+        return files
+
+    def handle_request_json(self,path,req):
+        if len(self.cache)>self.max_cache:
+            self.cache.clear()
+        if len(self.previews)>self.max_cache:
+            self.previews.clear()
+        if path=="/md2xml":
+            errors=[]
+            xml=text_to_xml_string(req['text'],files=self.image_files(req.get('base_dir',".")),seed=req.get('seed'),
+                                   sort_questions=req.get('sort',True),errors=errors,cache=self.cache)
+            return {'xml':xml,'errors':errors}
+        if path=="/xml2md":
+            errors=[]
+            text,files=xml_string_to_text(req['xml'],md=req.get('md',True),sort_questions=req.get('sort',True),errors=errors)
+            return {'text':text,'images':dict((k,base64.b64encode(v).decode('ASCII')) for k,v in files.items()),'errors':errors}
+        if path=="/check":
+            return {'problems':check_text(req['text'],base_dir=req.get('base_dir',"."),jobs=1)}
+        if path=="/preview":
+            # Every document has its own cache, pruned to its blocks; without
+            # a "document" id the directory's cache is shared and not pruned.
+            base_dir=os.path.abspath(req.get('base_dir',"."))
+            document=req.get('document')
+            cache=self.previews.get((base_dir,document))
+            if cache is None:
+                cache=self.previews.setdefault((base_dir,document),LockedCache())
+            if len(cache)>self.max_cache:
+                cache.clear()
+            return {'html':preview_text(req['text'],image_dir="file://"+base_dir,jobs=1,cache=cache,prune=document is not None)}
+        raise Exception('Unknown request: '+path)
+
+def serve(port=8765):
+    server=ConversionServer(("127.0.0.1",port))
+    print("Serving on http://127.0.0.1:"+str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        None
+    server.server_close()
 
 
 # # Applying xml->text->xml
@@ -2482,35 +5167,133 @@ import os
 import shutil
 
 
-def TEXTtoXML(filenameIn,filenameOut,overwrite=False,sort_questions=True):
-    if ((not(overwrite)) and (os.path.isfile(filenameOut))):
+def locate_block(text,block):
+    i=text.find(block.strip())
+    if i<0:
+        i=max(text.find(block.strip().split("\n")[0]),0)
+    return text.count("\n",0,i)+1,len(text[:i].encode('utf-8'))
+
+def write_error_report(errors,filename):
+    with open(filename,"w") as f:
+        json.dump(errors,f,indent=1)
+    for e in errors:
+        print("WARNING! ########################################################## Skipped question ["+str(e['category'])+" / "+str(e['name'])+"] at line "+str(e.get('line'))+(" of "+e['file'] if 'file' in e else "")+": "+e['exception'])
+    print(str(len(errors))+" questions failed. Report written to "+filename)
+
+def read_include_cache(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (OSError,ValueError):
+        return {}
+
+def TEXTtoXML(filenameIn,filenameOut,overwrite=False,sort_questions=True,categories=None,names=None,max_bytes=None,split_categories=False,keep_going=False,memprofile=False,progress=None,jobs=None):
+    if (max_bytes) or (split_categories):
+        first=shard_filename(filenameOut,1)
+    else:
+        first=filenameOut
+    if ((not(overwrite)) and (os.path.isfile(first))):
         print("File already exists. Exiting")
         return
-    with open(filenameIn) as f:
-        contents = f.read()
+    if (memprofile):
+        prof=MemoryProfile()
+        prof.start()
+    with profile_stage('read'):
+        with open(filenameIn) as f:
+            original = f.read()
+    contents=original
     if (sort_questions):
-        contents=sort_qs_in_text(contents)
-    text_to_xml(contents,filenameOut)
+        with profile_stage('sort'):
+            contents=sort_qs_in_text(contents)
+    errors=[] if keep_going else None
+    if (progress):
+        prog=Progress(progress)
+        prog.start()
+    includes=None
+    if len(included_files(contents))>0:
+        includes=IncludedFiles(os.path.dirname(os.path.abspath(filenameIn)),cache=read_include_cache(filenameOut+".includes.json"),
+                               sort_questions=sort_questions,categories=categories,names=names,errors=errors,jobs=jobs)
+        with profile_stage('includes'):
+            n=includes.prepare(contents,filenameIn)
+        print("Compiled "+str(n)+" of "+str(len(includes.keys))+" included files.")
+    with profile_stage('convert'):
+        text_to_xml(contents,filenameOut,categories=categories,names=names,max_bytes=max_bytes,split_categories=split_categories,errors=errors,includes=includes)
+    if includes is not None:
+        with open(filenameOut+".includes.json","w") as f:
+            json.dump(includes.cache,f)
+    if (progress):
+        prog.stop()
+    if (memprofile):
+        prof.stop()
+        prof.write(filenameOut+".memprofile.json")
+    if (keep_going):
+        for e in errors:
+            if 'block' in e:
+                e['line'],e['offset']=locate_block(original,e.pop('block'))
+        write_error_report(errors,filenameOut+".errors.json")
     
 
-def XMLtoTEXT(filenameIn,filenameOut,overwrite=False,sort_questions=True,md=True,save_images=False):
-    if ((not(overwrite)) and (os.path.isfile(filenameOut))):
+def XMLtoTEXT(filenameIn,filenameOut,overwrite=False,sort_questions=True,md=True,save_images=False,sync=False,keep_going=False,memprofile=False,progress=None,jobs=None):
+    if ((not(overwrite)) and (not(sync)) and (os.path.isfile(filenameOut))):
         print("File already exists. Exiting")
         return
+    if (memprofile):
+        prof=MemoryProfile()
+        prof.start()
     
-    with open(filenameIn) as fd:
-        quiz_dict = xmltodict.parse(fd.read())
-    quiz_dict = quiz_dict['quiz']
+    with profile_stage('parse'):
+        if filenameIn[-4:]==".mbz":
+            quiz_dict = mbz_to_quiz(filenameIn)
+        else:
+            with open(filenameIn) as fd:
+                quiz_dict = xmltodict.parse(fd.read())
+            quiz_dict = quiz_dict['quiz']
     
     #tree = ET.parse(filenameIn)
     #quiz = tree.getroot()
 
-    aa=xml_to_text(quiz_dict,MARKDOWNIFY=md, save_images=save_images)
-    if (sort_questions):
-        aa=sort_qs_in_text(aa)
-    text_file = open(filenameOut, "wt")
-    text_file.write(aa)
-    text_file.close()
+    errors=[] if keep_going else None
+    if (progress):
+        prog=Progress(progress)
+        prog.start()
+    if (sync) and (os.path.isfile(filenameOut)):
+        with open(filenameOut) as f:
+            old_text=f.read()
+        with profile_stage('convert'):
+            aa,hashes=sync_xml_to_text(quiz_dict,old_text,read_sync_hashes(filenameOut+".sync.json"),MARKDOWNIFY=md,save_images=save_images,sort_questions=sort_questions,errors=errors)
+    else:
+        with profile_stage('convert'):
+            aa=xml_to_text(quiz_dict,MARKDOWNIFY=md, save_images=save_images,errors=errors,jobs=jobs)
+        if (sort_questions):
+            with profile_stage('sort'):
+                aa=sort_qs_in_text(aa)
+        if (sync):
+            hashes=xml_question_hashes(quiz_dict,MARKDOWNIFY=md)
+            keys=list(hashes)
+            for e in (errors or []):
+                hashes.pop(keys[e['question']],None)
+    if (progress):
+        prog.stop()
+    if (keep_going):
+        index=[]
+        if filenameIn[-4:]!=".mbz":
+            with open(filenameIn,"rb") as f:
+                data=f.read()
+            index=index_xml_bank(data)
+        for e in errors:
+            if e['question']<len(index):
+                e['offset']=index[e['question']]['offset']
+                e['line']=data.count(b"\n",0,e['offset'])+1
+        write_error_report(errors,filenameOut+".errors.json")
+    with profile_stage('write'):
+        text_file = open(filenameOut, "wt")
+        text_file.write(aa)
+        text_file.close()
+    if (sync):
+        write_sync_hashes(hashes,filenameOut+".sync.json")
+    if (memprofile):
+        prof.stop()
+        prof.write(filenameOut+".memprofile.json")
 
 
 # In[ ]:
@@ -2525,12 +5308,28 @@ def XMLtoTEXT(filenameIn,filenameOut,overwrite=False,sort_questions=True,md=True
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('input',type=str,help='input filename')
+    parser.add_argument('input',type=str,nargs='?',help='input filename')
     parser.add_argument('--output','-o',type=str,help='output filename')
     parser.add_argument('--overwrite', '-rw',action='store_true')
     parser.add_argument('--no_sort_questions', '-sq',action='store_true')
     parser.add_argument('--no_markdown', '-xmd',action='store_true')
     parser.add_argument('--save_images', '-im',action='store_true')
+    parser.add_argument('--sync', '-sy',action='store_true',help='xml->md: update an existing md file, reconverting only the questions that changed')
+    parser.add_argument('--index', '-ix',action='store_true',help='write a byte-offset index of the questions in the input to input.idx.json')
+    parser.add_argument('--preview', '-pv',action='store_true',help='md: render the questions to an html page (output, input.preview.html by default) instead of converting')
+    parser.add_argument('--check', '-ck',action='store_true',help='md: only check the questions for problems, without writing any output')
+    parser.add_argument('--jobs', '-j',type=int,help='number of processes to use (--check, --preview and INCLUDE: files: all cores by default; xml->md: 1 by default)')
+    parser.add_argument('--keep_going', '--keep-going', '-k',action='store_true',help='skip questions that fail to convert and list them in output.errors.json')
+    parser.add_argument('--memprofile', '-mp',action='store_true',help='record the peak and retained memory of every stage of the conversion in output.memprofile.json')
+    parser.add_argument('--progress', '-pg',nargs='?',const='auto',choices=['auto','bar','json'],help='report the progress of the conversion on stderr as a progress bar or as JSON lines (default: bar on a terminal)')
+    parser.add_argument('--serve', '-sv',type=int,metavar='PORT',help='run a local conversion server on this port instead of converting a file')
+    parser.add_argument('--store', '-db',type=str,metavar='DB',help='add the questions of the input (md, xml or mbz) to this SQLite question store')
+    parser.add_argument('--search', '-s',type=str,help='db: FTS5 query selecting questions of the store given as input; they are listed, or exported to output (.xml or .md)')
+    parser.add_argument('--compare', '-cmp',type=str,help='xml: compare the questions of the input with those of this xml file')
+    parser.add_argument('--category', '-c',action='append',help='md->xml: only export categories matching this glob pattern (can be repeated)')
+    parser.add_argument('--name', '-n',action='append',help='md->xml: only export questions whose name matches this glob pattern (can be repeated)')
+    parser.add_argument('--split_categories', '-sc',action='store_true',help='md->xml: write every category to its own file output_001.xml, output_002.xml, ...')
+    parser.add_argument('--max_size', '-ms',type=str,help='md->xml: split the output into files of at most this size, e.g. 20M')
     # Parse arguments from terminal
     args = parser.parse_args()
 
@@ -2543,20 +5342,49 @@ if __name__ == "__main__":
     sort_questions=not((args.no_sort_questions))
     md=not((args.no_markdown))
     save_images=args.save_images
+    sync=args.sync
+    max_bytes=None
+    if args.max_size is not None:
+        max_bytes=parse_size(args.max_size)
     #print(overwrite)
     #print(filenameIn)
     #print(filenameOut)
-    if filenameIn[-3:]=="xml":
+    if (args.serve):
+        serve(args.serve)
+    elif filenameIn is None:
+        parser.error('the following arguments are required: input')
+    elif (args.index):
+        index=build_index(filenameIn)
+        print("Indexed "+str(len(index))+" questions in "+index_filename(filenameIn))
+    elif (args.preview):
+        if (filenameOut)==None:
+            filenameOut=os.path.splitext(filenameIn)[0]+".preview.html"
+        PREVIEWTEXT(filenameIn,filenameOut,jobs=args.jobs,overwrite=overwrite)
+    elif (args.check):
+        if len(CHECKTEXT(filenameIn,jobs=args.jobs))>0:
+            sys.exit(1)
+    elif (args.store):
+        STOREBANK(filenameIn,args.store,md=md,keep_going=args.keep_going,jobs=args.jobs)
+    elif os.path.splitext(filenameIn)[1] in ['.db','.sqlite']:
+        if QUERYSTORE(filenameIn,query=args.search,categories=args.category,names=args.name,filenameOut=filenameOut,overwrite=overwrite) is None:
+            sys.exit(1)
+    elif (args.compare):
+        print_comparison(compare_xml(filenameIn,args.compare))
+    elif filenameIn[-3:]=="xml":
+        if (filenameOut)==None:
+            filenameOut=filenameIn[:-3]+"md"
+        XMLtoTEXT(filenameIn,filenameOut,overwrite=overwrite,sort_questions=sort_questions,md=md,save_images=save_images,sync=sync,keep_going=args.keep_going,memprofile=args.memprofile,progress=args.progress,jobs=args.jobs)
+    elif filenameIn[-3:]=="mbz":
         if (filenameOut)==None:
             filenameOut=filenameIn[:-3]+"md"
-        XMLtoTEXT(filenameIn,filenameOut,overwrite=overwrite,sort_questions=sort_questions,md=md,save_images=save_images)
-    if filenameIn[-2:]=="md":
+        XMLtoTEXT(filenameIn,filenameOut,overwrite=overwrite,sort_questions=sort_questions,md=md,save_images=save_images,sync=sync,keep_going=args.keep_going,memprofile=args.memprofile,progress=args.progress,jobs=args.jobs)
+    elif filenameIn[-2:]=="md":
         if (filenameOut)==None:
             filenameOut=filenameIn[:-2]+"xml"
-        TEXTtoXML(filenameIn,filenameOut,overwrite=overwrite,sort_questions=sort_questions)
-    if filenameIn[-3:]=="txt":
+        TEXTtoXML(filenameIn,filenameOut,overwrite=overwrite,sort_questions=sort_questions,categories=args.category,names=args.name,max_bytes=max_bytes,split_categories=args.split_categories,keep_going=args.keep_going,memprofile=args.memprofile,progress=args.progress,jobs=args.jobs)
+    elif filenameIn[-3:]=="txt":
         if len(filenameOut)==0:
             filenameOut=filenameIn[:-3]+"xml"
-        TEXTtoXML(filenameIn,filenameOut,overwrite=overwrite,sort_questions=sort_questions)
+        TEXTtoXML(filenameIn,filenameOut,overwrite=overwrite,sort_questions=sort_questions,categories=args.category,names=args.name,max_bytes=max_bytes,split_categories=args.split_categories,keep_going=args.keep_going,memprofile=args.memprofile,progress=args.progress,jobs=args.jobs)
 
 